@@ -7,6 +7,7 @@ import sys
 import glob
 import os
 import random
+from copy import copy
 from configparser import ConfigParser
 
 import pygame
@@ -16,19 +17,36 @@ from core.store import SettingsStore
 from core.defaults import Settings
 from gsm import MainMenuScreen
 from fsm import StateMachine
-from utils import add_vecs, mul_vec
+from utils import add_vecs, mul_vec, LRUCache
 from constants import PANEL_H, CELL_SIZE, SCR_W, SCR_H, WHITE, BLACK
-from combat import ShotManager
 
 NUM_HUMAN_PLAYERS = 2
 
 VERSION = 'v0.2.1'
 
+# Maximum number of rendered strings kept by the graphics manager
+TEXT_CACHE_SIZE = 256
+
+
+def get_area_key(area):
+    """Return the source area of a blit as a hashable tuple or None."""
+    return None if area is None else tuple(area)
+
 
 class GraphicsManager(object):
     """Simple graphics manager"""
     def __init__(self, surf):
         self.surf = surf
+        self.background = None
+        self.full_redraw = True
+        # Draw calls are only recorded between begin_frame and end_frame
+        self.frame_open = False
+        # Draw calls of the current and the last frame, as (source,
+        # position, area, screen rect) where source is a surface or the
+        # color of a filled rect
+        self.commands = []
+        self.prev_commands = []
+        self.text_cache = LRUCache(TEXT_CACHE_SIZE)
         self.textures = {}
         for img in glob.glob('../gfx/*.png'):
             surf = pygame.image.load(img)
@@ -51,19 +69,185 @@ class GraphicsManager(object):
         if tex_name not in self.textures:
             raise Exception('No such texture: {0}'.format(tex_name))
         if gridcoords:
-            self.surf.blit(self.textures[tex_name],
-                           add_vecs(mul_vec(pos, CELL_SIZE), offset),
-                           area=area)
+            pos = mul_vec(pos, CELL_SIZE)
+        self.blit(self.textures[tex_name], add_vecs(pos, offset), area)
+
+    def draw_cells(self, tex_name, cells, offset=(0, PANEL_H)):
+        """
+        Draw areas of a texture to grid cells in one go.
+        :param cells: iterable of (pos, area) pairs
+        """
+        tex = self.textures[tex_name]
+        blits = [(tex, add_vecs(mul_vec(pos, CELL_SIZE), offset), area)
+                 for pos, area in cells]
+
+        if self.deferred:
+            rects = [self.get_blit_rect(*blit) for blit in blits]
         else:
-            self.surf.blit(self.textures[tex_name],
-                           add_vecs(pos, offset), area=area)
+            rects = self.surf.blits(blits)
 
-    def draw_string(self, pos, text, color, big=False):
-        if big:
-            font_surf = self.xolonium_font20.render(text, True, color)
+        if self.frame_open:
+            self.commands.extend((tex, pos, get_area_key(area), tuple(rect))
+                                 for (tex, pos, area), rect
+                                 in zip(blits, rects))
+
+    @property
+    def deferred(self):
+        """
+        Determine if drawing is deferred to end_frame, which is the case
+        within a frame once the screen has been drawn in full.
+        """
+        return self.frame_open and not self.full_redraw
+
+    def blit(self, source, pos, area=None):
+        """Draw a surface."""
+        if self.deferred:
+            rect = self.get_blit_rect(source, pos, area)
+        else:
+            rect = self.surf.blit(source, pos, area)
+
+        if self.frame_open:
+            self.commands.append((source, tuple(pos), get_area_key(area),
+                                  tuple(rect)))
+
+    def get_blit_rect(self, source, pos, area=None):
+        """Return the part of the screen a blit would draw to."""
+        if area is None:
+            rect = source.get_rect(topleft=pos)
         else:
-            font_surf = self.xolonium_font14.render(text, True, color)
-        self.surf.blit(font_surf, pos)
+            rect = pygame.Rect(pos, pygame.Rect(area).clip(
+                source.get_rect()).size)
+
+        return rect.clip(self.surf.get_rect())
+
+    def create_layer(self, size):
+        """
+        Create a graphics manager drawing to a transparent off-screen
+        surface of the given size. Textures and fonts are shared.
+        """
+        layer = copy(self)
+        layer.surf = pygame.Surface(size, pygame.SRCALPHA)
+        # Layers are drawn to right away and never record draw calls
+        layer.frame_open = False
+        layer.commands = []
+        layer.prev_commands = []
+        return layer
+
+    def blit_layer(self, layer, pos, area=None):
+        """
+        Draw the surface of a layer created by create_layer. Skipped if
+        the layer is the background of the current frame, as it is
+        already on screen then.
+        :param area: part of the layer to draw or None for all of it
+        """
+        if self.background is not None and self.background[0] is layer:
+            return
+
+        self.blit(layer.surf, pos, area)
+
+    def begin_frame(self, background=None):
+        """
+        Prepare the screen for a new frame. If the background is the same
+        as in the last frame, drawing is recorded and end_frame redraws
+        only what changed. Otherwise the whole screen is redrawn.
+        :param background: a layer and its offset on screen or None
+        """
+        if background is None or background[0] is None:
+            background = None
+            self.full_redraw = True
+        elif background != self.background:
+            self.full_redraw = True
+
+        self.background = background
+        self.frame_open = True
+        self.commands = []
+
+        if self.full_redraw:
+            self.surf.fill(BLACK)
+
+            if background is not None:
+                self.surf.blit(background[0].surf, background[1])
+
+    def end_frame(self):
+        """
+        Push the frame to the display. After a full redraw that is the
+        whole screen. Otherwise only the areas of draw calls which are
+        new or gone since the last frame are restored from the
+        background, drawn again and pushed. A moving snake thus only
+        costs its head and tail, a still powerup or text nothing.
+        """
+        if self.full_redraw:
+            pygame.display.update()
+        else:
+            dirty_rects = self.get_dirty_rects()
+            rects = [command[3] for command in self.commands]
+
+            for rect in dirty_rects:
+                self.redraw(rect, rects)
+
+            self.surf.set_clip(None)
+            pygame.display.update(dirty_rects)
+
+        self.prev_commands = self.commands
+        self.frame_open = False
+        self.full_redraw = False
+
+    def get_dirty_rects(self):
+        """Return the rects of the draw calls which changed."""
+        prev = set(self.prev_commands)
+        curr = set(self.commands)
+        return [pygame.Rect(command[3]) for command
+                in (prev - curr) | (curr - prev)]
+
+    def redraw(self, rect, rects):
+        """
+        Restore the background in rect and repeat the draw calls of the
+        frame covering it.
+        :param rects: screen rects of the draw calls
+        """
+        layer, (off_x, off_y) = self.background
+        self.surf.set_clip(rect)
+        self.surf.fill(BLACK, rect)
+        self.surf.blit(layer.surf, rect, area=rect.move(-off_x, -off_y))
+
+        for index in rect.collidelistall(rects):
+            source, pos, area, cmd_rect = self.commands[index]
+
+            if isinstance(source, pygame.Surface):
+                self.surf.blit(source, pos, area)
+            else:
+                self.surf.fill(source, cmd_rect)
+
+    def invalidate(self):
+        """Redraw the whole screen in the next frame."""
+        self.full_redraw = True
+
+    def draw_rect(self, color, pos, size):
+        """Draw a filled rectangle."""
+        rect = pygame.Rect(pos, size)
+
+        if self.deferred:
+            rect = rect.clip(self.surf.get_rect())
+        else:
+            rect = pygame.draw.rect(self.surf, color, rect)
+
+        if self.frame_open:
+            self.commands.append((tuple(color), tuple(pos), None,
+                                  tuple(rect)))
+
+    def draw_string(self, pos, text, color, big=False):
+        """Draw a string, reusing the surface if rendered recently."""
+        key = (text, tuple(color), big)
+        font_surf = self.text_cache.get(key)
+
+        if font_surf is None:
+            if big:
+                font_surf = self.xolonium_font20.render(text, True, color)
+            else:
+                font_surf = self.xolonium_font14.render(text, True, color)
+            self.text_cache.put(key, font_surf)
+
+        self.blit(font_surf, pos)
 
     def get_size(self, text, big=False):
         if big:
@@ -179,8 +363,6 @@ class BattleSnakesGame(StateMachine):
         self.graphics = GraphicsManager(self.screen)
         self.settings = SettingsStore('../settings.json', Settings)
 
-        self.shot_manager = ShotManager(self)
-
         self.h_player_configs = []
 
         for hpid in range(NUM_HUMAN_PLAYERS):
@@ -210,11 +392,16 @@ class BattleSnakesGame(StateMachine):
             for event in pygame.event.get():
                 if event.type == QUIT:
                     self.quit()
-            self.screen.fill(BLACK)
             delta_time = (self.fps_clock.tick(60) / 1000.0)
             self.update(delta_time)
+
+            if self.settings['dirty_rects']:
+                self.graphics.begin_frame(self.current_state.background)
+            else:
+                self.graphics.begin_frame()
+
             self.draw()
-            pygame.display.update()
+            self.graphics.end_frame()
 
 
 def main():
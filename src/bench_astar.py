@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the A* implementation against the previous one, which is kept
+here unchanged for comparison.
+"""
+
+import argparse
+import random
+from timeit import default_timer
+from heapq import heappush, heappop
+from collections import defaultdict
+
+from utils import add_vecs, sub_vecs, get_adjacent
+from core.map import TileMapBase, on_edge
+from pathfinding import AStar, WALL_PENALTY_MAX_SPREAD
+
+DEFAULT_MAP = '../data/maps/test01.battle-snakes.map'
+# Spacing of the walls and width of their gaps on the maze map
+MAZE_SPACING = 32
+MAZE_GAP = 4
+
+
+class LegacyNode(object):
+    def __init__(self, pos, blocked=False, penalty=0):
+        self.pos = pos
+        self._gcost = 0
+        self._hcost = 0
+        self._fcost = self._gcost + self._hcost
+        self.penalty = penalty
+        self.blocked = blocked
+        self.parent = None
+
+    def get_fcost(self):
+        return self._fcost
+
+    def get_gcost(self):
+        return self._gcost
+
+    def set_gh(self, gcost, hcost):
+        self._gcost = gcost + self.penalty
+        self._hcost = hcost
+        self._fcost = self._gcost + self._hcost
+
+    def __lt__(self, other):
+        return self._fcost < other.get_fcost()
+
+    def __eq__(self, other):
+        return self.pos == other.pos
+
+    def __hash__(self):
+        return hash(self.pos)
+
+
+class LegacyAStar(object):
+    """
+    The A* implementation before the rewrite.
+    """
+    def __init__(self, tilemap):
+        self.rows = tilemap.height
+        self.cols = tilemap.width
+        self.blocked = set(tilemap.blocked)
+        self.tilemap = tilemap
+        self.open_lst = list()
+        self.clsd_lst = set()
+        self.nodes = [None] * self.cols
+        self.nodes = [[None] * self.rows for _ in self.nodes]
+
+        penalty = defaultdict(int)
+
+        for tile in tilemap.blocked:
+            for adjacent in get_adjacent(tile, self.cols, self.rows):
+                if adjacent in self.blocked:
+                    continue
+
+                spread_dir = sub_vecs(adjacent, tile)
+                spread_count = 1
+                spread = add_vecs(tile, spread_dir)
+
+                while (spread not in self.blocked
+                       and not on_edge(spread)
+                       and spread_count < WALL_PENALTY_MAX_SPREAD):
+                    penalty[spread] += 12 / spread_count
+
+                    spread = add_vecs(spread, spread_dir)
+                    spread_count += 1
+
+        for xpos in range(self.cols):
+            for ypos in range(self.rows):
+                pos = (xpos, ypos)
+                pen = penalty.get((xpos, ypos), 0)
+                self.nodes[xpos][ypos] = LegacyNode(pos, pos in self.blocked,
+                                                    pen)
+
+    def find_path(self, start_pos, dest_pos, blocked=None):
+        self.open_lst = list()
+        self.clsd_lst = set()
+        path = []
+        start_node = LegacyNode(start_pos)
+        dest_node = LegacyNode(dest_pos)
+
+        heappush(self.open_lst, start_node)
+
+        while len(self.open_lst) != 0:
+            curr_node = heappop(self.open_lst)
+            self.clsd_lst.add(curr_node)
+
+            if curr_node == dest_node:
+                parent = curr_node.parent
+
+                while parent != start_node:
+                    path.append(parent.pos)
+                    parent = parent.parent
+
+                return path
+
+            if blocked:
+                self.expand_node(curr_node, dest_node, blocked)
+            else:
+                self.expand_node(curr_node, dest_node, [])
+
+        return None
+
+    def expand_node(self, curr_node, dest_node, blocked):
+        for adjacent in self.get_adjacent(curr_node):
+            if (adjacent.blocked or adjacent in self.clsd_lst or
+                    adjacent.pos in blocked):
+                continue
+
+            tentative_g = adjacent.get_gcost()
+
+            if adjacent in self.open_lst and \
+                    tentative_g >= adjacent.get_gcost():
+                continue
+
+            adjacent.parent = curr_node
+
+            heuristics = abs(dest_node.pos[0] - adjacent.pos[0]) + \
+                abs(dest_node.pos[1] - adjacent.pos[1])
+
+            adjacent.set_gh(tentative_g, heuristics)
+
+            if adjacent not in self.open_lst:
+                heappush(self.open_lst, adjacent)
+
+    def get_adjacent(self, node):
+        xpos, ypos = node.pos
+
+        if xpos > 0:
+            yield self.nodes[xpos - 1][ypos]
+        else:
+            yield self.nodes[self.cols-1][ypos]
+
+        if ypos < self.rows - 1:
+            yield self.nodes[xpos][ypos + 1]
+        else:
+            yield self.nodes[xpos][0]
+
+        if xpos < self.cols - 1:
+            yield self.nodes[xpos + 1][ypos]
+        else:
+            yield self.nodes[0][ypos]
+
+        if ypos > 0:
+            yield self.nodes[xpos][ypos - 1]
+        else:
+            yield self.nodes[xpos][self.rows-1]
+
+
+def make_maze_map(cols, rows):
+    """
+    Return a map of vertical walls with a gap alternating between the top
+    and the bottom. Paths wind around the walls, so the Manhattan distance
+    underestimates badly and landmarks help.
+    """
+    tilemap = TileMapBase('', cols, rows)
+
+    for xpos in range(MAZE_SPACING, cols - 1, MAZE_SPACING):
+        if xpos // MAZE_SPACING % 2:
+            gap = range(1, MAZE_GAP + 1)
+        else:
+            gap = range(rows - MAZE_GAP - 1, rows - 1)
+
+        tilemap.blocked.update((xpos, ypos) for ypos in range(rows)
+                               if ypos not in gap)
+
+    return tilemap
+
+
+def path_cost(astar, path, dest_pos):
+    """Cost of a path as returned by find_path, including dest."""
+    return sum(astar.cost[astar.index(pos)] for path_pos in (path, [dest_pos])
+               for pos in path_pos)
+
+
+def random_queries(tilemap, num, seed):
+    """Return num pairs of distinct, unblocked positions."""
+    randomizer = random.Random(seed)
+    free = [(xpos, ypos) for xpos in range(tilemap.width)
+            for ypos in range(tilemap.height)
+            if (xpos, ypos) not in tilemap.blocked]
+
+    return [tuple(randomizer.sample(free, 2)) for _ in range(num)]
+
+
+def bench(astar, queries):
+    """
+    Run all queries.
+    :return: seconds taken and the paths found
+    """
+    paths = []
+    start_t = default_timer()
+
+    for start_pos, dest_pos in queries:
+        paths.append(astar.find_path(start_pos, dest_pos))
+
+    return default_timer() - start_t, paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark A*')
+    parser.add_argument('--map', default=DEFAULT_MAP)
+    parser.add_argument('--maze', action='store_true',
+                        help='benchmark a generated maze instead of --map')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=13)
+
+    args = parser.parse_args()
+
+    tilemap = make_maze_map(128, 128) if args.maze else TileMapBase(args.map)
+    queries = random_queries(tilemap, args.queries, args.seed)
+    astar = AStar(tilemap)
+    impls = (('legacy', LegacyAStar(tilemap)), ('astar', astar),
+             ('alt', AStar(tilemap, use_landmarks=True)))
+
+    # Landmarks are built by the first search, keep that out of the timing
+    tilemap.landmarks
+
+    for name, impl in impls:
+        secs, paths = bench(impl, queries)
+        found = [(path, query[1]) for path, query in zip(paths, queries)
+                 if path is not None]
+        cost = sum(path_cost(astar, path, dest) for path, dest in found)
+
+        print('{0:>8}: {1:8.2f} ms/query, {2} of {3} found, '
+              'total cost {4:.1f}'.format(name, secs * 1000. / len(queries),
+                                          len(found), len(queries), cost))
+
+if __name__ == '__main__':
+    main()
@@ -7,10 +7,11 @@ Snake AI powered by a Finite State Machine and Potential Fields.
 from abc import abstractmethod
 from heapq import nsmallest
 from copy import copy
+from operator import itemgetter
 
 from player import PlayerBase
 from fsm import State, StateMachine
-from utils import m_distance, sub_vecs
+from utils import m_distance, sub_vecs, normalize
 from pathfinding import Pathfinder
 from snake import get_next_to_portal
 
@@ -25,7 +26,7 @@ class BotState(State):
         self.bot = bot
 
     @abstractmethod
-    def update(self, delta_time):
+    def update(self):
         pass
 
 
@@ -43,15 +44,19 @@ class BotCollectState(BotState):
         self.path = []
         self.pwrup_table = []
 
-        self.snake = bot.snake
-        self.game = bot.game
+        self.sim = bot.sim
+        self.planned_from = None
 
         self.t_alive = 0
 
-    def update(self, delta_time):
+    @property
+    def snake(self):
+        return self.bot.snake
+
+    def update(self):
         self.prev_target = self.target
         self.pwrup_table = []
-        for pwrup in self.game.pwrup_manager.get_powerups():
+        for pwrup in self.sim.pwrup_manager.get_powerups():
             dis = m_distance(self.snake.body[0], pwrup.pos)
             score = self.bot.pwrup_score[pwrup.pid]
 
@@ -64,38 +69,88 @@ class BotCollectState(BotState):
                 [elem[2].pos for elem in self.pwrup_table]:
             self.aquire_target()
 
+        if self.bot.flow_fields is not None:
+            self.follow_flow_field()
+            return
+
+        if self.bot.pathfinder.avoids_snakes:
+            self.follow_replanned_path()
+            return
+
         if self.prev_target != self.target:
             self.path = self.bot.pathfinder.find_path(self.snake[0],
                                                       self.target.pos)
-            assert self.path
+            # Unreachable for now, keep the heading and pick another
+            # target next time
+            if self.path is None:
+                self.path = []
+                self.target = None
+                return
 
             self.path.insert(0, self.target.pos)
-            heading = sub_vecs(self.path[-1], self.snake[0])
-            self.bot.snake.set_heading(heading)
+            self.bot.snake.set_heading(self.heading_to(self.path[-1]))
 
         if self.path[-1] == self.snake[0] and len(self.path) >= 1:
-            if m_distance(self.path[-1], self.path[-2]) > 1:
-                portal = get_next_to_portal(self.snake[0],
-                                            self.game.tilemap)
-                if portal:
-                    heading = sub_vecs(portal, self.snake[0])
-                else:
-                    heading = sub_vecs(self.snake[0], self.path[-2])
-
-            else:
-                heading = sub_vecs(self.path[-2], self.snake[0])
+            heading = self.heading_to(self.path[-2])
             self.path.pop()
             self.bot.snake.set_heading(heading)
 
-    def enter(self, old_state):
+    def heading_to(self, pos):
+        """
+        Return the heading from the head to the next position of a path,
+        which may be behind a portal or across the edge of the map.
+        """
+        if m_distance(pos, self.snake[0]) > 1:
+            portal = get_next_to_portal(self.snake[0], self.sim.tilemap)
+
+            if portal:
+                return sub_vecs(portal, self.snake[0])
+
+            return sub_vecs(self.snake[0], pos)
+
+        return sub_vecs(pos, self.snake[0])
+
+    def follow_replanned_path(self):
+        """
+        Replan whenever the head has moved or the target has changed and
+        head towards the first step of the path.
+        """
+        if (self.planned_from == self.snake[0] and
+                self.prev_target == self.target):
+            return
+
+        self.planned_from = self.snake[0]
+        path = self.bot.pathfinder.find_path(self.snake[0], self.target.pos,
+                                             self.snake)
+
+        # Blocked by snakes for now, keep going
+        if path is None:
+            return
+
+        heading = self.heading_to(path[-1] if path else self.target.pos)
+
+        if normalize(heading) != self.snake.heading:
+            self.bot.snake.set_heading(heading)
+
+    def follow_flow_field(self):
+        """Head towards the target along the shared flow field."""
+        # Never turn around into the own body
+        heading = self.bot.flow_fields.get_heading(self.snake[0],
+                                                   self.target.pos,
+                                                   self.snake[1])
+
+        if heading is not None and heading != self.snake.heading:
+            self.bot.snake.set_heading(heading)
+
+    def enter(self):
         pass
 
     def leave(self):
         pass
 
     def aquire_target(self):
-        selection = nsmallest(4, self.pwrup_table)
-        self.target = copy(self.game.randomizer.choice(selection)[2])
+        selection = nsmallest(4, self.pwrup_table, key=itemgetter(0, 1))
+        self.target = copy(self.sim.randomizer.choice(selection)[2])
 
 
 class BotAttackState(BotState):
@@ -107,10 +162,10 @@ class BotAttackState(BotState):
     def __init__(self, bot):
         BotState.__init__(self, bot)
 
-    def update(self, delta_time):
+    def update(self):
         pass
 
-    def enter(self, old_state):
+    def enter(self):
         pass
 
     def leave(self):
@@ -123,17 +178,24 @@ class Bot(PlayerBase, StateMachine):
     Basic bot class.
     """
 
-    def __init__(self, game_mode, dead_handler, kwargs):
-        PlayerBase.__init__(self, game_mode, dead_handler, **kwargs)
+    def __init__(self, sim, dead_handler, kwargs):
+        PlayerBase.__init__(self, sim, dead_handler, **kwargs)
         StateMachine.__init__(self, BotCollectState(self))
 
-        self.pathfinder = Pathfinder(self.game)
+        self.flow_fields = (sim.flow_fields if kwargs.get('flow_fields', True)
+                            else None)
+        # Replan around snakes as they move, only without flow fields
+        replan = self.flow_fields is None
+        self.pathfinder = Pathfinder(
+            sim, incremental=replan and kwargs.get('incremental', False),
+            dynamic=replan and kwargs.get('dynamic_obstacles', False),
+            cache=sim.path_cache if kwargs.get('path_cache', True) else None)
         self.pwrup_target_weights = {'points': -0.1, 'grow': 0.1,
                                      'speed': -0.05, 'boost': -0.00001,
                                      'lifes': -100, 'hp': -0.8}
         self.pwrup_score = {}
 
-        for pwrup in list(self.game.pwrup_manager.pwrup_prototypes.values()):
+        for pwrup in list(self.sim.pwrup_manager.pwrup_prototypes.values()):
             pid = pwrup['pid']
             self.pwrup_score[pid] = 0
             targets = pwrup['actions']
@@ -144,8 +206,10 @@ class Bot(PlayerBase, StateMachine):
                 self.pwrup_score[pid] += target['value'] * weight
             self.pwrup_score[pid] *= num_targets
 
-    def update(self, delta_time):
+    def update(self):
         """Update fsm and player base."""
+        if not self.snake:
+            return
 
-        self.current_state.update(delta_time)
-        PlayerBase.update(self, delta_time)
+        self.current_state.update()
+        PlayerBase.update(self)
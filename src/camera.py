@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cameras showing a part of the map in a rectangle of the screen. Maps
+larger than the screen are shown through one camera per player, each
+following the snake of its player, side by side.
+"""
+
+from constants import CELL_SIZE, PANEL_H
+
+# Screen offset of grid coordinates without a camera
+DEFAULT_OFFSET = (0, PANEL_H)
+
+# Cells rendered beyond every side of the view, so the camera can move
+# that far before the map has to be rendered again
+CAMERA_MARGIN = 16
+
+
+def get_offset(camera):
+    """Return the screen offset of grid coordinates in camera."""
+    return camera.offset if camera is not None else DEFAULT_OFFSET
+
+
+class Camera(object):
+    """
+    View of a tile map in a rectangle of the screen. Things outside the
+    view are culled, the map is pre-rendered around the view and
+    rendered again once the view leaves the pre-rendered area.
+    :param rect: screen x, y, width, height in pixels
+    :param player: player to follow or None
+    """
+
+    def __init__(self, tilemap, rect, player=None):
+        self.tilemap = tilemap
+        self.rect = rect
+        self.player = player
+        self.cols = min(rect[2] // CELL_SIZE, tilemap.width)
+        self.rows = min(rect[3] // CELL_SIZE, tilemap.height)
+        # Top left cell of the view
+        self.pos = (0, 0)
+        self.layer = None
+        # Cells x, y, width, height of the map rendered into the layer
+        self.layer_rect = None
+
+    @property
+    def viewport(self):
+        """Return the cells x, y, width, height in view."""
+        return self.pos + (self.cols, self.rows)
+
+    @property
+    def offset(self):
+        """Return the screen offset of grid coordinates."""
+        return (self.rect[0] - self.pos[0] * CELL_SIZE,
+                self.rect[1] - self.pos[1] * CELL_SIZE)
+
+    @property
+    def shows_layer(self):
+        """Determine if the view shows exactly the pre-rendered layer."""
+        return self.layer is not None and self.layer_rect == self.viewport
+
+    def contains(self, pos):
+        """Determine if pos is in view."""
+        return (0 <= pos[0] - self.pos[0] < self.cols and
+                0 <= pos[1] - self.pos[1] < self.rows)
+
+    def center_on(self, pos):
+        """Move the view so pos is in the middle, staying on the map."""
+        self.pos = (min(max(pos[0] - self.cols // 2, 0),
+                        self.tilemap.width - self.cols),
+                    min(max(pos[1] - self.rows // 2, 0),
+                        self.tilemap.height - self.rows))
+
+    def update(self):
+        """Follow the snake of the player."""
+        if self.player is not None and self.player.snake:
+            self.center_on(self.player.snake[0])
+
+    def render(self, gfx_manager):
+        """Render the map in view and the margin around it."""
+        margin = CAMERA_MARGIN
+        self.layer_rect = self.tilemap.tiles.clip(
+            (self.pos[0] - margin, self.pos[1] - margin,
+             self.cols + 2 * margin, self.rows + 2 * margin))
+        self.layer = self.tilemap.render_layer(gfx_manager,
+                                               self.layer_rect)
+
+    def draw_map(self, gfx_manager):
+        """Draw the map in view, rendering it first if necessary."""
+        if self.layer is None or not self.layer_covers_view():
+            self.render(gfx_manager)
+
+        left, top = (self.pos[0] - self.layer_rect[0],
+                     self.pos[1] - self.layer_rect[1])
+        gfx_manager.blit_layer(self.layer, self.rect[:2],
+                               (left * CELL_SIZE, top * CELL_SIZE,
+                                self.cols * CELL_SIZE,
+                                self.rows * CELL_SIZE))
+
+    def layer_covers_view(self):
+        """Determine if the view is inside the pre-rendered area."""
+        left, top, width, height = self.layer_rect
+        return (left <= self.pos[0] and top <= self.pos[1] and
+                self.pos[0] + self.cols <= left + width and
+                self.pos[1] + self.rows <= top + height)
+
+
+def split_screen(tilemap, rect, players):
+    """
+    Return the cameras for a match. A map fitting into rect is shown by
+    a single camera, otherwise rect is split into a camera per player.
+    :param rect: screen x, y, width, height in pixels
+    """
+    if (tilemap.width * CELL_SIZE <= rect[2] and
+            tilemap.height * CELL_SIZE <= rect[3]) or not players:
+        camera = Camera(tilemap, rect, players[0] if players else None)
+        camera.update()
+        return [camera]
+
+    # Views are a whole number of cells wide
+    width = rect[2] // len(players) // CELL_SIZE * CELL_SIZE
+    cameras = []
+
+    for index, player in enumerate(players):
+        camera = Camera(tilemap, (rect[0] + index * width, rect[1], width,
+                                  rect[3]), player)
+        camera.update()
+        cameras.append(camera)
+
+    return cameras
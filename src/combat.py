@@ -3,8 +3,9 @@
 Combat module.
 """
 
-from utils import add_vecs, mul_vec
-from core.map import wrap_around
+from utils import add_vecs, mul_vec, secs_to_ticks, rate_to_units
+from constants import STEP_UNITS, SHOT_TAG
+from camera import get_offset
 
 
 # Emitters
@@ -37,11 +38,11 @@ DEFAULT_SHOT_LIFETIME = 3.5
 
 class Shot(object):
     """Represents a shot."""
-    def __init__(self, game, pos, heading, tag, config):
-        self.game = game
+    def __init__(self, sim, pos, heading, tag, config):
+        self.sim = sim
         self.isalive = True
         self.isvisible = True
-        self.elapsed_t = 0
+        self.move_progress = 0
         self.elapsed_blink = 0
         self.elapsed_lifetime = 0
         self.pos = pos
@@ -49,18 +50,21 @@ class Shot(object):
         self.tag = tag
         self.tex = config['tex']
         self.damage = config.get('damage', 0)
-        self.speed = 1. / config['speed'] if 'speed' in config else 10000
+        self.speed = rate_to_units(config.get('speed', 0))
         self.slowdown = config.get('slowdown', 0)
-        self.blinkrate = config.get('blinkrate', DEFAULT_SHOT_BLINK_RATE)
-        self.lifetime = config.get('lifetime', DEFAULT_SHOT_LIFETIME)
+        self.blinkrate = secs_to_ticks(config.get('blinkrate',
+                                                  DEFAULT_SHOT_BLINK_RATE))
+        self.lifetime = secs_to_ticks(config.get('lifetime',
+                                                 DEFAULT_SHOT_LIFETIME))
 
         self.reinit(pos, heading, tag, config)
 
     def reinit(self, pos, heading, tag, config):
         """Reinit shot."""
+        self.sim.spatialhash.insert(pos, SHOT_TAG, self)
         self.isalive = True
         self.isvisible = True
-        self.elapsed_t = 0
+        self.move_progress = 0
         self.elapsed_blink = 0
         self.elapsed_lifetime = 0
         self.pos = pos
@@ -68,25 +72,34 @@ class Shot(object):
         self.tag = tag
         self.tex = config['tex']
         self.damage = config.get('damage', 0)
-        self.speed = 1. / config['speed'] if 'speed' in config else 10000
+        self.speed = rate_to_units(config.get('speed', 0))
         self.slowdown = config.get('slowdown', 0)
-        self.blinkrate = config.get('blinkrate', DEFAULT_SHOT_BLINK_RATE)
-        self.lifetime = config.get('lifetime', DEFAULT_SHOT_LIFETIME)
+        self.blinkrate = secs_to_ticks(config.get('blinkrate',
+                                                  DEFAULT_SHOT_BLINK_RATE))
+        self.lifetime = secs_to_ticks(config.get('lifetime',
+                                                 DEFAULT_SHOT_LIFETIME))
 
     def hit(self):
         """Tell the shot that it has hit something."""
-        self.isalive = False
+        if self.isalive:
+            self.isalive = False
+            self.sim.spatialhash.remove(self.pos, SHOT_TAG, self)
 
-    def update(self, delta_time):
-        """Update shot."""
-        self.elapsed_t += delta_time
-        self.elapsed_blink += delta_time
-        self.elapsed_lifetime += delta_time
+    def move_to(self, pos):
+        """Move shot to pos."""
+        self.sim.spatialhash.move(self.pos, pos, SHOT_TAG, self)
+        self.pos = pos
+
+    def update(self):
+        """Advance shot by one tick."""
+        self.move_progress += self.speed
+        self.elapsed_blink += 1
+        self.elapsed_lifetime += 1
 
-        if self.elapsed_t >= self.speed:
-            self.elapsed_t -= self.speed
-            self.pos = add_vecs(self.pos, self.heading)
-            self.pos = wrap_around(self.pos)
+        if self.move_progress >= STEP_UNITS:
+            self.move_progress -= STEP_UNITS
+            self.move_to(self.sim.tilemap.wrap_around(
+                add_vecs(self.pos, self.heading)))
 
         if self.elapsed_blink >= self.blinkrate:
             self.elapsed_blink -= self.blinkrate
@@ -95,10 +108,10 @@ class Shot(object):
         if self.elapsed_lifetime >= self.lifetime:
             self.hit()
 
-    def draw(self):
+    def draw(self, gfx, camera=None):
         """Draw shot."""
         if self.isvisible:
-            self.game.graphics.draw(self.tex, self.pos)
+            gfx.draw(self.tex, self.pos, offset=get_offset(camera))
 
 
 class ShotManager(object):
@@ -107,8 +120,8 @@ class ShotManager(object):
     Shot manager.
     """
 
-    def __init__(self, game):
-        self.game = game
+    def __init__(self, sim):
+        self.sim = sim
         self.shot_pool = []
 
     def create_shot(self, pos, heading, tag, config):
@@ -117,19 +130,24 @@ class ShotManager(object):
             if not shot.isalive:
                 shot.reinit(pos, heading, tag, config)
                 return
-        self.shot_pool.append(Shot(self.game, pos, heading, tag, config))
+        self.shot_pool.append(Shot(self.sim, pos, heading, tag, config))
 
-    def update(self, delta_time):
+    def update(self):
         """Update shots."""
         for shot in self.shot_pool:
             if shot.isalive:
-                shot.update(delta_time)
+                shot.update()
+
+    def clear(self):
+        """Clear shot pool."""
+        self.shot_pool = list()
 
-    def draw(self):
-        """Draw shots."""
+    def draw(self, gfx, camera=None):
+        """Draw shots, only those in view if a camera is given."""
         for shot in self.shot_pool:
-            if shot.isalive:
-                shot.draw()
+            if shot.isalive and (camera is None or
+                                 camera.contains(shot.pos)):
+                shot.draw(gfx, camera)
 
 
 class Weapon(object):
@@ -138,34 +156,34 @@ class Weapon(object):
     Represents a weapon.
     """
 
-    def __init__(self, game, owner, config):
-        self.game = game
+    def __init__(self, sim, owner, config):
+        self.sim = sim
         self.owner = owner
         self.ammo = config['ammo']
         self.shot = config['shot']
         self.wtype = config['type']
-        self.firerate = 1. / config['freq']
+        self.firerate = rate_to_units(config['freq'])
         self.emitter = config.get('emitter', DEFAULT_EMITTER)
-        self.elapsed_t = 0
+        self.fire_progress = 0
         self.firing = False
-        self.time_since_last_shot = 0
+        self.since_last_shot = 0
 
     def set_firing(self, value):
         """Set 'firing' property."""
         if (self.firing and not value and
-                self.time_since_last_shot >= self.firerate):
-            self.elapsed_t = self.firerate
+                self.since_last_shot >= STEP_UNITS):
+            self.fire_progress = STEP_UNITS
         self.firing = value
 
-    def update(self, delta_time):
-        """Update weapon."""
-        self.time_since_last_shot += delta_time
+    def update(self):
+        """Advance weapon by one tick."""
+        self.since_last_shot += self.firerate
 
         if self.firing:
-            self.elapsed_t += delta_time
+            self.fire_progress += self.firerate
 
-        if self.elapsed_t >= self.firerate:
-            self.elapsed_t -= self.firerate
+        if self.fire_progress >= STEP_UNITS:
+            self.fire_progress -= STEP_UNITS
             if self.ammo > 0:
                 if self.owner.snake.heading is not None:
                     head = None
@@ -178,14 +196,16 @@ class Weapon(object):
                         heading = (-self.owner.snake.heading[0],
                                    -self.owner.snake.heading[1])
 
-                    if (add_vecs(head, mul_vec(heading, 1)) not in
-                            self.game.tilemap.tiles and head not in
-                            self.game.tilemap.tiles):
+                    grid = self.sim.grid
+                    wrap_around = self.sim.tilemap.wrap_around
+                    front = wrap_around(add_vecs(head, mul_vec(heading, 1)))
+
+                    if not grid.is_wall(front) and not grid.is_wall(head):
                         self.ammo -= 1
-                        self.game.shot_manager.create_shot(
-                            add_vecs(head, mul_vec(heading, 2)),
+                        self.sim.shot_manager.create_shot(
+                            wrap_around(add_vecs(front, heading)),
                             heading, self.owner.snake.head_tag,
                             self.shot)
-                    self.time_since_last_shot = 0
+                    self.since_last_shot = 0
             else:
                 self.firing = False
@@ -1,5 +1,12 @@
 # -*- coding: utf-8 -*-
 
+# Simulation
+TICK_RATE = 60
+MAX_CATCHUP_TICKS = 5
+# Rates are accumulated as integers, one step takes STEP_UNITS.
+RATE_SCALE = 1000
+STEP_UNITS = TICK_RATE * RATE_SCALE
+
 INVINCIBILITY_BLINK_RATE = 0.1
 
 # Speed
@@ -22,6 +29,7 @@ MAX_HITPOINTS = 500
 
 # Grid & size
 CELL_SIZE = 10
+# Size of new maps and of the screen, maps carry their own size
 ROWS = 64
 COLS = 128
 PANEL_H = 42
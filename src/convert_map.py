@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Convert maps from the zip format to the binary format.
+"""
+
+import argparse
+
+from core.map import TileMapBase
+from core.binmap import BINARY_EXT, write_binary_map
+
+ZIP_EXT = '.battle-snakes.map'
+
+
+def get_output_path(map_path):
+    """Return the path of the binary map next to map_path."""
+    if map_path.endswith(ZIP_EXT):
+        return map_path[:-len(ZIP_EXT)] + BINARY_EXT
+    return map_path + BINARY_EXT
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert maps to the binary format')
+    parser.add_argument('maps', nargs='+')
+    parser.add_argument('--output', help='output path, only for a single map')
+    parser.add_argument('--no-labels', action='store_true',
+                        help="don't store the island labels")
+
+    args = parser.parse_args()
+
+    if args.output and len(args.maps) > 1:
+        parser.error('--output requires a single map')
+
+    for map_path in args.maps:
+        output_path = args.output or get_output_path(map_path)
+        write_binary_map(TileMapBase(map_path), output_path,
+                         not args.no_labels)
+        print('{0} -> {1}'.format(map_path, output_path))
+
+if __name__ == '__main__':
+    main()
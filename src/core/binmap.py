@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact binary map format. All numbers are little endian. The file
+starts with a fixed size header, followed by
+
+- the tile plane: one uint8 or uint16 per cell, row by row
+- the blocked bitplane: one bit per cell, by flat index
+- optionally the island label plane: one int8, int16 or int32 per
+  cell, the smallest which holds all labels
+- the portals: x, y, partner x, partner y, exit x, exit y as int16
+- the spawnpoints: x, y as int16
+- the remaining meta data (title, description, textures and the
+  number of islands if there are labels) as JSON
+
+The planes start at fixed offsets, so the file is memory-mapped and
+read without parsing anything cell by cell.
+"""
+
+import sys
+import json
+import mmap
+import struct
+from array import array
+
+from utils import to_bitboard, atomic_write
+from core.tilestore import TileStore
+from core.cellset import CellSet
+
+BINARY_MAGIC = b'BSMAP'
+BINARY_VERSION = 1
+BINARY_EXT = '.battle-snakes.bmap'
+# magic, version, cols, rows, bytes per tile, flags, number of portals,
+# number of spawnpoints, length of the JSON meta data
+BINARY_HEADER = struct.Struct('<5sBHHBBHHI')
+PORTAL_STRUCT = struct.Struct('<6h')
+SPAWNPOINT_STRUCT = struct.Struct('<2h')
+
+# Header flags
+HAS_LABELS = 0x01
+# Labels are int8 or int16 instead of int32
+LABELS_INT8 = 0x02
+LABELS_INT16 = 0x04
+
+# Header flags of the label planes by array type code
+LABEL_FLAGS = {'b': LABELS_INT8, 'h': LABELS_INT16, 'i': 0}
+
+# Array type codes of the tile planes by bytes per tile
+TILE_TYPECODES = {1: 'B', 2: 'H'}
+
+
+def is_binary_map(filepath):
+    """Determine if filepath is a map in the binary format."""
+    with open(filepath, 'rb') as map_file:
+        return map_file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def _read_plane(data, typecode):
+    """Return a little endian plane as an array."""
+    plane = array(typecode)
+    plane.frombytes(data)
+
+    if sys.byteorder == 'big' and plane.itemsize > 1:
+        plane.byteswap()
+
+    return plane
+
+
+def _write_plane(map_file, plane):
+    """Write an array as a little endian plane."""
+    if sys.byteorder == 'big' and plane.itemsize > 1:
+        plane = array(plane.typecode, plane)
+        plane.byteswap()
+
+    plane.tofile(map_file)
+
+
+def read_binary_map(filepath):
+    """
+    Read a map in the binary format.
+    :return: dict with the cols, rows, title, description, textures,
+    spawnpoints, portals, tiles (as a TileStore), blocked cells (as a
+    CellSet), the island labels and the number of islands, both None if
+    the file has no labels
+    """
+    with open(filepath, 'rb') as map_file:
+        with mmap.mmap(map_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+
+            try:
+                return _parse(view)
+            finally:
+                view.release()
+
+
+def _parse(data):
+    """Parse a memory-mapped map. Only copies leave this function."""
+    try:
+        (magic, version, cols, rows, tile_bytes, flags, num_portals,
+         num_spawnpoints, meta_len) = BINARY_HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError('truncated map header')
+
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError('not a binary map of version {0}'.format(
+            BINARY_VERSION))
+
+    if tile_bytes not in TILE_TYPECODES:
+        raise ValueError('invalid tile size {0}'.format(tile_bytes))
+
+    label_typecode = 'i'
+
+    for typecode, flag in LABEL_FLAGS.items():
+        if flags & flag:
+            label_typecode = typecode
+
+    size = cols * rows
+    offset = BINARY_HEADER.size
+    sections = [size * tile_bytes, (size + 7) // 8,
+                (size * array(label_typecode).itemsize
+                 if flags & HAS_LABELS else 0),
+                num_portals * PORTAL_STRUCT.size,
+                num_spawnpoints * SPAWNPOINT_STRUCT.size, meta_len]
+
+    if len(data) != offset + sum(sections):
+        raise ValueError('map size does not match its header')
+
+    views = []
+
+    for length in sections:
+        views.append(data[offset:offset + length])
+        offset += length
+
+    tiles_view, blocked_view, labels_view, portals_view, sp_view, \
+        meta_view = views
+
+    tile_plane = _read_plane(tiles_view, TILE_TYPECODES[tile_bytes])
+    tiles = TileStore(cols, rows)
+
+    for pos_y in range(rows):
+        tiles.set_row(pos_y, tile_plane[pos_y * cols:(pos_y + 1) * cols])
+
+    meta = json.loads(bytes(meta_view).decode('utf-8'))
+
+    portals = {}
+
+    for values in PORTAL_STRUCT.iter_unpack(portals_view):
+        portals[values[0:2]] = (values[2:4], values[4:6])
+
+    has_labels = flags & HAS_LABELS and 'num_islands' in meta
+    data = {key: meta[key] for key in ('title', 'description')
+            if key in meta}
+    data.update({
+        'cols': cols,
+        'rows': rows,
+        'textures': {int(tid): tex for (tid, tex)
+                     in meta.get('textures', {}).items()},
+        'spawnpoints': list(SPAWNPOINT_STRUCT.iter_unpack(sp_view)),
+        'portals': portals,
+        'tiles': tiles,
+        'blocked': CellSet(cols, rows, bits=blocked_view),
+        'island_labels': (_read_plane(labels_view, label_typecode)
+                          if has_labels else None),
+        'num_islands': meta['num_islands'] if has_labels else None,
+    })
+
+    return data
+
+
+def write_binary_map(tilemap, file_path, labels=True):
+    """
+    Write a tile map in the binary format.
+    :param labels: if True, the island labels of the map are included
+    """
+    cols, rows = tilemap.width, tilemap.height
+    tile_plane = array('B')
+
+    if tilemap.tiles.max_tile() > 0xFF:
+        tile_plane = array('H')
+
+    for pos_y in range(rows):
+        tile_plane.extend(tilemap.tiles.get_row(pos_y))
+
+    if isinstance(tilemap.blocked, CellSet):
+        blocked_bits = bytes(tilemap.blocked.bits)
+    else:
+        blocked_bits = to_bitboard(
+            (pos_y * cols + pos_x for pos_x, pos_y in tilemap.blocked),
+            cols * rows).to_bytes((cols * rows + 7) // 8, 'little')
+
+    label_plane = None
+
+    if labels:
+        label_plane = tilemap.island_labels
+
+        if label_plane.typecode not in LABEL_FLAGS:
+            label_plane = array('i', label_plane)
+
+    meta = {'title': tilemap.title,
+            'description': tilemap.description,
+            'textures': tilemap.textures}
+
+    if labels:
+        meta['num_islands'] = tilemap.num_islands
+
+    meta = json.dumps(meta).encode('utf-8')
+
+    with atomic_write(file_path) as map_file:
+        map_file.write(BINARY_HEADER.pack(
+            BINARY_MAGIC, BINARY_VERSION, cols, rows, tile_plane.itemsize,
+            (HAS_LABELS | LABEL_FLAGS[label_plane.typecode]
+             if labels else 0), len(tilemap.portals),
+            len(tilemap.spawnpoints), len(meta)))
+
+        _write_plane(map_file, tile_plane)
+        map_file.write(blocked_bits)
+
+        if labels:
+            _write_plane(map_file, label_plane)
+
+        for portal, (partner, exit_dir) in tilemap.portals.items():
+            map_file.write(PORTAL_STRUCT.pack(*(portal + partner +
+                                                exit_dir)))
+
+        for spawnpoint in tilemap.spawnpoints:
+            map_file.write(SPAWNPOINT_STRUCT.pack(*spawnpoint))
+
+        map_file.write(meta)
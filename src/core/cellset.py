@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sets of map cells stored as bitsets. Maps with many blocked cells would
+otherwise hold a tuple per cell; a bitset takes one bit per cell of the
+map and tests membership with a shift.
+"""
+
+from collections.abc import MutableSet
+
+from utils import iter_bits
+
+
+class CellSet(MutableSet):
+    """
+    Set of (x, y) cells of a cols x rows map. Bit i of the bitset, in
+    little endian order, stands for the cell with the flat index i,
+    which is the layout of the blocked bitplane of binary maps.
+    """
+
+    def __init__(self, cols, rows, cells=(), bits=None):
+        """
+        :param cells: cells to add
+        :param bits: bitset to copy, as bytes of the same layout
+        """
+        self.cols = cols
+        self.rows = rows
+        size = (cols * rows + 7) // 8
+
+        if isinstance(cells, CellSet) and (cells.cols, cells.rows) == \
+                (cols, rows):
+            bits = cells.bits
+            cells = ()
+
+        if bits is None:
+            self.bits = bytearray(size)
+        elif len(bits) != size:
+            raise ValueError('bitset does not match the map size')
+        else:
+            self.bits = bytearray(bits)
+
+        self.count = bin(int.from_bytes(self.bits, 'little')).count('1')
+
+        for cell in cells:
+            self.add(cell)
+
+    def _index(self, cell):
+        """Return the flat index of cell, or -1 if it is off the map."""
+        pos_x, pos_y = cell
+
+        if 0 <= pos_x < self.cols and 0 <= pos_y < self.rows:
+            return pos_y * self.cols + pos_x
+
+        return -1
+
+    def __contains__(self, cell):
+        index = self._index(cell)
+        return index >= 0 and bool(self.bits[index >> 3] & 1 << (index & 7))
+
+    def __iter__(self):
+        cols = self.cols
+
+        for index in iter_bits(int.from_bytes(self.bits, 'little')):
+            yield index % cols, index // cols
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return 'CellSet({0}, {1}, {2!r})'.format(self.cols, self.rows,
+                                                 sorted(self))
+
+    def _from_iterable(self, cells):
+        # Set operations return plain sets, their cells need no map
+        return set(cells)
+
+    def add(self, cell):
+        index = self._index(cell)
+
+        if index < 0:
+            raise ValueError('cell {0} is off the map'.format(cell))
+
+        mask = 1 << (index & 7)
+
+        if not self.bits[index >> 3] & mask:
+            self.bits[index >> 3] |= mask
+            self.count += 1
+
+    def discard(self, cell):
+        index = self._index(cell)
+
+        if index >= 0 and self.bits[index >> 3] & 1 << (index & 7):
+            self.bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+            self.count -= 1
+
+    def update(self, cells):
+        """Add all cells, like set.update."""
+        for cell in cells:
+            self.add(cell)
+
+    def copy(self):
+        """Return a copy which doesn't share the bitset."""
+        return CellSet(self.cols, self.rows, bits=self.bits)
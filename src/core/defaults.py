@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
 
 Settings = {
+        'dirty_rects': True,
         }
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+"""
+Landmark distance tables (ALT) for tile maps. For a few landmark cells
+the distances from and to every other cell are precomputed, taking
+walls, the wrap-around at the map edges and portals into account. By
+the triangle inequality these give lower bounds on the distance between
+any two cells, which makes for a much better informed A* heuristic than
+the Manhattan distance on maps with walls.
+
+The tables only depend on the map, so they are kept with the other data
+derived from the map file and stored in its sidecar file.
+"""
+
+from array import array
+from collections import deque
+
+from core.mapcache import get_derived
+
+NUM_LANDMARKS = 8
+# Number of landmarks used per search
+ACTIVE_LANDMARKS = 2
+
+# Headings of the steps from a cell, in the order of the step arrays
+HEADINGS = ((-1, 0), (0, 1), (1, 0), (0, -1))
+
+# Distance of cells which can't be reached, by array type code
+UNREACHABLE = {'H': 0xFFFF, 'I': 0xFFFFFFFF}
+
+
+def get_steps(cols, rows):
+    """
+    Return the cell reached by a step from every cell, wrapping around
+    the edges of the map, as one array per heading of HEADINGS.
+    """
+    size = cols * rows
+    left = array('i', range(-1, size - 1))
+    right = array('i', range(1, size + 1))
+
+    for row_start in range(0, size, cols):
+        left[row_start] = row_start + cols - 1
+        right[row_start + cols - 1] = row_start
+
+    down = array('i', range(cols, size + cols))
+    down[size - cols:] = array('i', range(cols))
+    up = array('i', range(-cols, size - cols))
+    up[:cols] = array('i', range(size - cols, size))
+
+    return left, down, right, up
+
+
+class Neighbours(object):
+    """
+    Neighbours of every cell by flat index. Instead of a tuple per cell,
+    the neighbour in every heading is kept in one flat array per heading
+    of HEADINGS, -1 if there is none. The few cells with more neighbours
+    have the rest in extra. Indexing returns the neighbours of a cell.
+    """
+    def __init__(self, steps, extra=None, headings=False):
+        """
+        :param headings: if True, neighbours are (index, heading) pairs,
+        which only the neighbours in steps have
+        """
+        self.steps = steps
+        self.extra = extra if extra is not None else {}
+        self.headings = headings
+
+    def __len__(self):
+        return len(self.steps[0])
+
+    def __getitem__(self, index):
+        left, down, right, up = self.steps
+        adjacent = (left[index], down[index], right[index], up[index])
+
+        if self.headings:
+            return tuple((adj, heading) for adj, heading
+                         in zip(adjacent, HEADINGS) if adj >= 0)
+
+        # Most cells are neither next to walls nor portals
+        if -1 in adjacent:
+            adjacent = tuple(adj for adj in adjacent if adj >= 0)
+
+        extra = self.extra.get(index)
+        return adjacent + extra if extra else adjacent
+
+    def with_headings(self):
+        """Return the same neighbours as (index, heading) pairs."""
+        return Neighbours(self.steps, self.extra, True)
+
+
+def get_neighbours(tilemap):
+    """
+    Get the cells reachable in one step from every cell and the cells
+    from which every cell is reachable in one step. Stepping onto a
+    portal leads to the cell in front of its partner. Walls and portals
+    themselves have no successors.
+
+    Both start out as the steps on the wrapped grid, only the steps from
+    and onto walls and portals are changed.
+    :return: the successors and the predecessors as Neighbours
+    """
+    cols, rows = tilemap.width, tilemap.height
+    walls = bytearray(cols * rows)
+    cells = []
+    portal_exits = {}
+
+    for pos_x, pos_y in tilemap.blocked:
+        walls[pos_y * cols + pos_x] = 1
+        cells.append(pos_y * cols + pos_x)
+
+    for portal, (partner, exit_dir) in tilemap.portals.items():
+        exit_x = (partner[0] + exit_dir[0]) % cols
+        exit_y = (partner[1] + exit_dir[1]) % rows
+        portal_exits[portal[1] * cols + portal[0]] = exit_y * cols + exit_x
+
+    grid_steps = get_steps(cols, rows)
+    successors = [array('i', steps) for steps in grid_steps]
+    predecessors = [array('i', steps) for steps in grid_steps]
+    # Predecessors through portals, by exit
+    portal_preds = {}
+
+    for cell in cells + list(portal_exits):
+        for heading, steps in enumerate(grid_steps):
+            opposite = (heading + 2) % 4
+            # No steps from cell
+            successors[heading][cell] = -1
+            predecessors[opposite][steps[cell]] = -1
+            # The step onto cell from the cell behind it leads elsewhere
+            pred = grid_steps[opposite][cell]
+            predecessors[opposite][cell] = -1
+
+            if walls[pred] or pred in portal_exits:
+                continue
+
+            exit_cell = portal_exits.get(cell)
+
+            if exit_cell is None or walls[exit_cell]:
+                successors[heading][pred] = -1
+            else:
+                successors[heading][pred] = exit_cell
+                portal_preds.setdefault(exit_cell, []).append(pred)
+
+    portal_preds = {exit_cell: tuple(preds)
+                    for exit_cell, preds in portal_preds.items()}
+
+    return Neighbours(successors), Neighbours(predecessors, portal_preds)
+
+
+def get_distance_typecode(size):
+    """
+    Return the array type code of distances and cells on a map of size
+    cells. Maps of more than 0xFFFE cells need 32 bits.
+    """
+    return 'H' if size < UNREACHABLE['H'] else 'I'
+
+
+def bfs(graph, source, typecode='H'):
+    """
+    Return the distances of all cells from source in graph, given as
+    Neighbours.
+    """
+    unreachable = UNREACHABLE[typecode]
+    dist = array(typecode, [unreachable]) * len(graph)
+    dist[source] = 0
+    queue = deque([source])
+    left, down, right, up = graph.steps
+    extra = graph.extra
+
+    while queue:
+        curr = queue.popleft()
+        next_dist = dist[curr] + 1
+
+        for adj in ((left[curr], down[curr], right[curr], up[curr]) +
+                    extra.get(curr, ())):
+            if adj >= 0 and dist[adj] == unreachable:
+                dist[adj] = next_dist
+                queue.append(adj)
+
+    return dist
+
+
+class LandmarkTable(object):
+    """
+    Distances from (fwd) and to (bwd) a set of landmark cells. Portals
+    are one-way in general, hence both directions.
+    """
+    def __init__(self, cols, rows, landmarks, fwd, bwd):
+        self.cols = cols
+        self.rows = rows
+        self.landmarks = landmarks
+        self.fwd = fwd
+        self.bwd = bwd
+        self.typecode = get_distance_typecode(cols * rows)
+        self.unreachable = UNREACHABLE[self.typecode]
+
+    @classmethod
+    def build(cls, tilemap, num_landmarks=NUM_LANDMARKS):
+        """
+        Build the table for a tile map. Landmarks are picked by farthest
+        point selection: every new landmark is the cell farthest away
+        from all landmarks picked so far.
+        """
+        successors, predecessors = get_neighbours(tilemap)
+        candidates = [index for index, adjacent
+                      in enumerate(zip(*successors.steps))
+                      if max(adjacent) >= 0]
+        landmarks = []
+        fwd = []
+        bwd = []
+
+        if not candidates:
+            return cls(tilemap.width, tilemap.height, landmarks, fwd, bwd)
+
+        typecode = get_distance_typecode(len(successors))
+        nearest = array(typecode, [UNREACHABLE[typecode]]) * len(successors)
+        landmark = candidates[0]
+
+        while len(landmarks) < num_landmarks:
+            landmarks.append(landmark)
+            fwd.append(bfs(successors, landmark, typecode))
+            bwd.append(bfs(predecessors, landmark, typecode))
+
+            for index in candidates:
+                nearest[index] = min(nearest[index], fwd[-1][index])
+
+            # Unreachable cells come first, they're in another island
+            landmark = max(candidates, key=nearest.__getitem__)
+
+            if nearest[landmark] == 0:
+                break
+
+        return cls(tilemap.width, tilemap.height, landmarks, fwd, bwd)
+
+    def get_heuristic(self, start, dest, active=ACTIVE_LANDMARKS):
+        """
+        Return a function computing lower bounds on the distance to
+        dest. Only the landmarks giving the best bounds at start are
+        used, which is cheaper than evaluating all of them.
+        """
+        # By the triangle inequality
+        #   d(L, dest) - d(L, index) <= d(index, dest)
+        #   d(index, L) - d(dest, L) <= d(index, dest)
+        terms = []
+        unreachable = self.unreachable
+
+        for field, dest_dist, sign in ([(fwd, fwd[dest], -1)
+                                        for fwd in self.fwd] +
+                                       [(bwd, bwd[dest], 1)
+                                        for bwd in self.bwd]):
+            if dest_dist == unreachable or field[start] == unreachable:
+                continue
+
+            terms.append((sign * (field[start] - dest_dist), field,
+                          dest_dist, sign))
+
+        terms = [term[1:] for term in
+                 sorted(terms, key=lambda term: -term[0])[:active]]
+
+        def heuristic(index):
+            bound = 0
+
+            for field, dest_dist, sign in terms:
+                dist = field[index]
+
+                if dist != unreachable and sign * (dist - dest_dist) > bound:
+                    bound = sign * (dist - dest_dist)
+
+            return bound
+
+        return heuristic
+
+    def to_array(self):
+        """
+        Return the landmarks followed by the forward and backward
+        distances as a single array.
+        """
+        values = array(self.typecode, self.landmarks)
+
+        for field in self.fwd + self.bwd:
+            values.extend(field)
+
+        return values
+
+    @classmethod
+    def from_array(cls, cols, rows, values):
+        """Return the table of a cols x rows map stored by to_array."""
+        size = cols * rows
+        count = len(values) // (1 + 2 * size)
+        landmarks = list(values[:count])
+        fields = [values[count + i * size:count + (i + 1) * size]
+                  for i in range(2 * count)]
+
+        return cls(cols, rows, landmarks, fields[:count], fields[count:])
+
+
+def load_landmarks(tilemap):
+    """
+    Return the landmark table of a tile map, built on first use and
+    stored in the sidecar file of its map file.
+    """
+    values = get_derived(tilemap, 'landmarks',
+                         lambda: LandmarkTable.build(tilemap).to_array(),
+                         True)
+    return get_derived(tilemap, 'landmark_table',
+                       lambda: LandmarkTable.from_array(
+                           tilemap.width, tilemap.height, values))
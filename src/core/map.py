@@ -4,15 +4,31 @@ import json
 from zipfile import ZipFile
 import os
 from heapq import nsmallest
-
-from utils import (vec_lst_to_str, str_to_vec_lst, str_to_vec,
-                   get_adjacent, m_distance, grid)
-from constants import COLS, ROWS
+from collections import deque
+from itertools import groupby, repeat
+from array import array
+
+from utils import (vec_lst_to_str, str_to_vec_lst, str_to_vec, m_distance,
+                   atomic_write)
+from constants import COLS, ROWS, CELL_SIZE
+from core.occupancy import SPAWNPOINT_CELL, SNAKE_CELL
+from core.landmarks import load_landmarks
+from core.tilestore import TileStore
+from core.cellset import CellSet
+from core.binmap import is_binary_map, read_binary_map
+from core.mapcache import map_cache, get_derived
 
 # Defaults for tile map meta data
 DEFAULT_TITLE = 'untitled'
 DEFAULT_DESC = 'no description'
 
+# Cells around a snake spawned off its spawnpoint which must be free of
+# other snakes
+SPAWN_CLEARANCE = 2
+
+# Maps any nonzero byte to 1
+_BLOCKED_TABLE = bytes([0] + [1] * 255)
+
 # Map object types
 TILE_OBJ = 0
 SPAWNPOINT_OBJ = 1
@@ -20,56 +36,223 @@ PORTAL_OBJ = 2
 BLOCKED_OBJ = 3
 
 
-def wrap_around(pos):
-    """Wrap obj around the map."""
+def wrap_around(pos, cols=COLS, rows=ROWS):
+    """Wrap obj around a map of cols x rows."""
     pos_x, pos_y = pos
     if pos_x < 0:
-        pos = (COLS - 1, pos_y)
-    if pos_x > COLS - 1:
+        pos = (cols - 1, pos_y)
+    if pos_x > cols - 1:
         pos = (0, pos_y)
     if pos_y < 0:
-        pos = (pos_x, ROWS - 1)
-    if pos_y > ROWS - 1:
+        pos = (pos_x, rows - 1)
+    if pos_y > rows - 1:
         pos = (pos_x, 0)
     return pos
 
 
-def on_edge(pos):
-    """Determines if pos is on the edge of the map."""
-    return (pos[0] == 0 or pos[0] == COLS-1 or
-            pos[1] == 0 or pos[1] == ROWS-1)
+def on_edge(pos, cols=COLS, rows=ROWS):
+    """Determines if pos is on the edge of a map of cols x rows."""
+    return (pos[0] == 0 or pos[0] == cols-1 or
+            pos[1] == 0 or pos[1] == rows-1)
+
+
+def label_islands(cols, rows, blocked):
+    """
+    Label the connected areas of unblocked cells. Every row is split
+    into runs of unblocked cells, which are merged with the overlapping
+    runs of the previous row by union-find. Work is done per run instead
+    of per cell, and labels are written a run at a time. Areas are
+    connected across the edges of the map, since moving objects wrap
+    around.
+    :param blocked: nonzero for blocked cells, by flat index
+    :return: the island of every cell by flat index, -1 for blocked
+    cells, as an array of the smallest type that fits, and the number of
+    islands
+    """
+    size = cols * rows
+    blocked = bytes(blocked).translate(_BLOCKED_TABLE)
+    # Runs as (first, last + 1) flat indices and their parent runs
+    runs = []
+    parent = []
+    row_runs = []
+
+    def find(run):
+        root = run
+        while parent[root] != root:
+            root = parent[root]
+        # Path compression
+        while parent[run] != root:
+            parent[run], run = root, parent[run]
+        return root
+
+    def union(run_a, run_b):
+        root_a = find(run_a)
+        root_b = find(run_b)
+        # The first run of an island is its root
+        if root_a < root_b:
+            parent[root_b] = root_a
+        elif root_b < root_a:
+            parent[root_a] = root_b
+
+    def union_rows(upper, lower):
+        """Merge the runs of two rows which share columns."""
+        i = j = 0
+        while i < len(upper) and j < len(lower):
+            up_first, up_end = runs[upper[i]]
+            low_first, low_end = runs[lower[j]]
+            if max(up_first % cols, low_first % cols) < \
+                    min((up_end - 1) % cols, (low_end - 1) % cols) + 1:
+                union(upper[i], lower[j])
+            if (up_end - 1) % cols < (low_end - 1) % cols:
+                i += 1
+            else:
+                j += 1
+
+    for row_start in range(0, size, cols):
+        row_end = row_start + cols
+        curr_runs = []
+        first = blocked.find(b'\x00', row_start, row_end)
+
+        while first >= 0:
+            end = blocked.find(b'\x01', first, row_end)
+            end = row_end if end < 0 else end
+            curr_runs.append(len(runs))
+            parent.append(len(runs))
+            runs.append((first, end))
+            first = blocked.find(b'\x00', end, row_end)
+
+        # Wrap around the left and right edges
+        if (len(curr_runs) > 1 and runs[curr_runs[0]][0] == row_start and
+                runs[curr_runs[-1]][1] == row_end):
+            union(curr_runs[0], curr_runs[-1])
+
+        if row_runs:
+            union_rows(row_runs[-1], curr_runs)
+
+        row_runs.append(curr_runs)
+
+    # Wrap around the top and bottom edges
+    if rows > 1:
+        union_rows(row_runs[-1], row_runs[0])
+
+    run_labels = []
+    num_islands = 0
+
+    for run in range(len(runs)):
+        root = find(run)
+
+        # Roots come first, so they are labelled before their islands
+        if root == run:
+            run_labels.append(num_islands)
+            num_islands += 1
+        else:
+            run_labels.append(run_labels[root])
+
+    typecode = get_label_typecode(num_islands)
+    labels = array(typecode, [-1]) * size
+
+    for (first, end), label in zip(runs, run_labels):
+        labels[first:end] = array(typecode, [label]) * (end - first)
+
+    return labels, num_islands
+
+
+def get_label_typecode(num_islands):
+    """
+    Return the array type code of the smallest signed integers holding
+    the labels of num_islands islands and -1.
+    """
+    if num_islands <= 0x80:
+        return 'b'
+    elif num_islands <= 0x8000:
+        return 'h'
+    return 'i'
 
 
-def flood_fill(the_map, map_size, start_pos):
+def read_zip_map(filepath):
     """
-    Slightly improved flood fill algorithm.
+    Read a map in the zip format, which holds the meta data as JSON and
+    the tiles and blocked cells as text.
+    :return: dict like core.binmap.read_binary_map
     """
-    # Using sets for faster look-up
-    open_lst = set()
-    closed_lst = set()
-    filled = set()
+    with ZipFile(filepath) as mapzip:
+        with mapzip.open('meta.json', 'r') as json_file:
+            config = json.load(json_file)
+
+        with mapzip.open('tiles', 'r') as tiles_file:
+            tiles_raw = tiles_file.read()
+
+        with mapzip.open('blocked', 'r') as blocked_file:
+            blocked_raw = blocked_file.read()
+
+    data = {key: config[key] for key in ('title', 'description')
+            if key in config}
+    data['cols'] = cols = config.get('cols', COLS)
+    data['rows'] = rows = config.get('rows', ROWS)
+    data['textures'] = {int(tid): tex for (tid, tex)
+                        in list(config.get('textures', {}).items())}
+    data['spawnpoints'] = [tuple(sp) for sp in config.get('spawnpoints', [])]
+    data['portals'] = {str_to_vec(p1.encode()): (tuple(p2[0]), tuple(p2[1]))
+                       for p1, p2 in list(config.get('portals', {}).items())}
+    data['tiles'] = TileStore(cols, rows)
+    data['blocked'] = set(str_to_vec_lst(blocked_raw))
+    data['island_labels'] = None
+    data['num_islands'] = None
+
+    if tiles_raw:
+        for pos_y, line in enumerate(tiles_raw.strip().split(b'\n')):
+            # Rows without tiles leave their chunks unallocated
+            if line.strip(b'0 \r'):
+                data['tiles'].set_row(pos_y,
+                                      [int(val) for val in line.split()])
+
+    return data
+
+
+def read_map_file(filepath):
+    """Read a map in the binary or the zip format."""
+    if is_binary_map(filepath):
+        return read_binary_map(filepath)
+    return read_zip_map(filepath)
 
-    open_lst.add(start_pos)
 
-    while open_lst:
-        pos_x, pos_y = open_lst.pop()
+class MapAccessibilityNode(object):
+    def __init__(self, tilemap, island, portals):
+        self.tilemap = tilemap
+        self.island = island
+        self.portals = portals
+        self._tiles = None
 
-        if the_map[pos_x][pos_y]:
-            filled.add((pos_x, pos_y))
-            closed_lst.add((pos_x, pos_y))
+    @property
+    def tiles(self):
+        """
+        Return the positions of the island, collecting them on first use.
+        Rows without the island are skipped, the others are walked a run
+        of equal labels at a time.
+        """
+        if self._tiles is None:
+            cols = self.tilemap.width
+            labels = self.tilemap.island_labels
+            self._tiles = set()
 
-            for adjacent in get_adjacent((pos_x, pos_y), map_size[0],
-                                         map_size[1]):
-                if adjacent not in closed_lst:
-                    open_lst.add(adjacent)
+            for pos_y in range(self.tilemap.height):
+                row = labels[pos_y * cols:(pos_y + 1) * cols]
 
-    return filled
+                if self.island not in row:
+                    continue
 
+                pos_x = 0
 
-class MapAccessibilityNode(object):
-    def __init__(self, tiles, portals):
-        self.tiles = tiles
-        self.portals = portals
+                for island, run in groupby(row):
+                    width = len(tuple(run))
+
+                    if island == self.island:
+                        self._tiles.update(zip(
+                            range(pos_x, pos_x + width), repeat(pos_y)))
+
+                    pos_x += width
+
+        return self._tiles
 
     def get_closest_portal(self, pos):
         ports = [(m_distance(pos, port), port) for port in self.portals]
@@ -79,74 +262,106 @@ class MapAccessibilityNode(object):
         return bool(self.portals)
 
     def contains_target(self, pos, target):
-        return pos not in self.tiles and target in self.tiles
+        return (self.tilemap.get_island(pos) != self.island and
+                self.tilemap.get_island(target) == self.island)
 
 
 class TileMapBase(object):
     """
-    Holds Tile Map data and provides basic funtionality like drawing
+    Holds Tile Map data and provides basic funtionality like drawing.
+    Maps are read from zip files or from files in the binary format,
+    through the process-wide map cache. Maps carry their own size, new
+    maps are cols x rows.
     """
-    def __init__(self, gfx_manager, filepath=''):
-        config = {}
-        tiles_raw = ''
-        blocked_raw = ''
+    def __init__(self, filepath='', cols=COLS, rows=ROWS):
+        data = {}
+        # Shared with other tile maps of the same file until edited
+        self.map_entry = None
 
         if os.path.exists(filepath):
-            with ZipFile(filepath) as mapzip:
-                with mapzip.open('meta.json', 'r') as json_file:
-                    config = json.load(json_file)
-
-                with mapzip.open('tiles', 'r') as tiles_file:
-                    tiles_raw = tiles_file.read()
-
-                with mapzip.open('blocked', 'r') as blocked_file:
-                    blocked_raw = blocked_file.read()
-
-        self.gfx_manager = gfx_manager
-        self.title = config.get('title', DEFAULT_TITLE)
-        self.description = config.get('description', DEFAULT_DESC)
-        self.textures = config.get('textures', {})
-        self.textures = {int(tid): tex for (tid, tex) in list(self.textures.items())}
-        self.spawnpoints = [tuple(sp) for sp in config.get('spawnpoints', [])]
-        self.portals = {}
-        self.tiles = [0] * COLS
-        self.tiles = [[0] * ROWS for _ in self.tiles]
-        self.blocked = set(str_to_vec_lst(blocked_raw))
+            self.map_entry = map_cache.get(filepath, read_map_file)
+            data = self.map_entry.data
+
+        # The cached data is shared, so copy everything which is edited
+        self.filepath = filepath
+        self.width = data.get('cols', cols)
+        self.height = data.get('rows', rows)
+        self.title = data.get('title', DEFAULT_TITLE)
+        self.description = data.get('description', DEFAULT_DESC)
+        self.textures = dict(data.get('textures', {}))
+        self.spawnpoints = list(data.get('spawnpoints', []))
+        self.portals = dict(data.get('portals', {}))
+        self.tiles = (data['tiles'].copy() if 'tiles' in data else
+                      TileStore(self.width, self.height))
+        self.blocked = CellSet(self.width, self.height,
+                               data.get('blocked', ()))
+        self.island_labels = data.get('island_labels')
+        self.num_islands = data.get('num_islands')
         self.islands = []
+        self._landmarks = None
+        self.layer = None
+        # Bumped by every edit, see invalidate()
+        self.version = 0
+        # Cells x, y, width, height of the map rendered into the layer
+        self.viewport = None
 
-        for p1, p2 in list(config.get('portals', {}).items()):
-            self.portals[str_to_vec(p1)] = (tuple(p2[0]), tuple(p2[1]))
+        if self.island_labels is None:
+            self._load_islands()
 
-        if tiles_raw:
-            for pos_y, line in enumerate(tiles_raw.strip().split(b'\n')):
-                for pos_x, val in enumerate(line.strip().split(b' ')):
-                    self.tiles[pos_x][pos_y] = int(val)
+        for island in range(self.num_islands):
+            portals = []
 
-        set_of_tiles = set(grid(COLS, ROWS))
-        set_of_tiles -= self.blocked
+            for portal in self.portals:
+                if (self.get_island(self.portals[portal][0]) == island and
+                        self.get_island(portal) != island):
+                    portals.append(portal)
 
-        accessibility_map = [None] * COLS
-        accessibility_map = [[None] * ROWS for _ in
-                             accessibility_map]
+            self.islands.append(MapAccessibilityNode(self, island, portals))
 
-        for pos_x, pos_y in grid(COLS, ROWS):
-            accessibility_map[pos_x][pos_y] = \
-                (pos_x, pos_y) not in self.blocked
+    def _load_islands(self):
+        """
+        Set the island labels and the number of islands, labelling the
+        map at most once. Both are persisted with the map file.
+        """
+        labelled = {}
 
-        while set_of_tiles:
-            pos = set_of_tiles.pop()
-            tiles = flood_fill(accessibility_map, (COLS, ROWS), pos)
-            portals = []
+        def build(name):
+            if not labelled:
+                walls = bytearray(self.width * self.height)
 
-            for portal in self.portals:
-                if (self.portals[portal][0] in tiles and
-                        portal not in tiles):
-                    portals.append(portal)
+                for pos_x, pos_y in self.blocked:
+                    walls[pos_y * self.width + pos_x] = 1
 
-            self.islands.append(
-                MapAccessibilityNode(tiles, portals))
+                labels, count = label_islands(self.width, self.height,
+                                              walls)
+                labelled.update(island_labels=labels,
+                                num_islands=array('l', [count]))
 
-            set_of_tiles -= tiles
+            return labelled[name]
+
+        self.island_labels = get_derived(
+            self, 'island_labels', lambda: build('island_labels'), True)
+        self.num_islands = get_derived(
+            self, 'num_islands', lambda: build('num_islands'), True)[0]
+
+    @property
+    def landmarks(self):
+        """Return the landmark table, loading it on first use."""
+        if self._landmarks is None:
+            self._landmarks = load_landmarks(self)
+        return self._landmarks
+
+    def get_island(self, pos):
+        """Return the island of pos, or -1 if pos is blocked."""
+        return self.island_labels[pos[1] * self.width + pos[0]]
+
+    def wrap_around(self, pos):
+        """Wrap pos around the edges of the map."""
+        return wrap_around(pos, self.width, self.height)
+
+    def on_edge(self, pos):
+        """Determine if pos is on the edge of the map."""
+        return on_edge(pos, self.width, self.height)
 
     def add_portal(self, p1, p2, p1_dir, p2_dir):
         """
@@ -175,57 +390,106 @@ class TileMapBase(object):
     def write_to_file(self, file_path):
         """
         Write map to a zip file containing metadata as a json and the
-        actual map data as a simple text file
+        actual map data as a simple text file. The members are built in
+        memory and the file is replaced atomically.
         :param file_path: path to the file
         :return:
         """
-        config = {'title': self.title, 'description': self.description}
+        config = {'title': self.title, 'description': self.description,
+                  'cols': self.width, 'rows': self.height}
         config['textures'] = self.textures
         config['spawnpoints'] = self.spawnpoints
         config['portals'] = {'{0}:{1}'.format(p1[0], p1[1]): p2 for
                              (p1, p2) in list(self.portals.items())}
 
-        with ZipFile(file_path, 'w') as mapzip:
-            with open('meta.json', 'w') as json_file:
-                json.dump(config, json_file)
-
-            with open('tiles', 'w') as tiles_file:
-                for pos_y in range(ROWS):
-                    for pos_x in range(COLS):
-                        fmt_str = '{0}' if pos_x == (COLS-1) else '{0} '
+        # One line of space separated tiles per row
+        tiles = ''.join(' '.join(map(str, self.tiles.get_row(pos_y))) + '\n'
+                        for pos_y in range(self.height))
 
-                        tiles_file.write(fmt_str.format(
-                            self.tiles[pos_x][pos_y]))
-                    tiles_file.write('\n')
+        with atomic_write(file_path) as map_file:
+            with ZipFile(map_file, 'w') as mapzip:
+                mapzip.writestr('meta.json', json.dumps(config))
+                mapzip.writestr('tiles', tiles)
+                mapzip.writestr('blocked', vec_lst_to_str(self.blocked))
 
-            with open('blocked', 'w') as blocked_file:
-                if self.blocked:
-                    blocked_file.write(vec_lst_to_str(self.blocked))
+    def get_full_viewport(self):
+        """Return the viewport showing the whole map."""
+        return 0, 0, self.width, self.height
 
-            for file in ('meta.json', 'tiles', 'blocked'):
-                mapzip.write(file)
-                os.remove(file)
+    def render(self, gfx_manager, viewport=None):
+        """
+        Render the part of the tile map inside the viewport into the
+        layer of the map, see render_layer. The layer is drawn until the
+        map is invalidated or the viewport changes.
+        :param viewport: cells x, y, width, height, by default the whole
+        map
+        :return: the layer
+        """
+        self.viewport = viewport or self.get_full_viewport()
+        self.layer = self.render_layer(gfx_manager, self.viewport)
+        return self.layer
 
-    def draw(self, offset=(0, 0)):
+    def render_layer(self, gfx_manager, viewport):
         """
-        Draw tile map, skipping tiles which have not texture assigned
-        :return:
+        Render the part of the tile map inside the viewport into a new
+        off-screen layer, skipping tiles which have no texture assigned.
+        Only the tile chunks intersecting the viewport are visited.
+        :param gfx_manager: graphics manager to create the layer with
+        :param viewport: cells x, y, width, height
+        :return: the layer
         """
-        for pos_x in range(COLS):
-            for pos_y in range(ROWS):
-                tile = self.tiles[pos_x][pos_y]
+        left, top, width, height = viewport
+        layer = gfx_manager.create_layer((width * CELL_SIZE,
+                                          height * CELL_SIZE))
 
-                if tile not in self.textures:
-                    continue
+        def in_viewport(pos):
+            return (left <= pos[0] < left + width and
+                    top <= pos[1] < top + height)
+
+        for (pos_x, pos_y), tile in self.tiles.iter_tiles(viewport):
+            if tile not in self.textures:
+                continue
 
-                self.gfx_manager.draw(self.textures[tile],
-                                      (pos_x, pos_y), True, offset)
+            layer.draw(self.textures[tile], (pos_x - left, pos_y - top),
+                       True, (0, 0))
 
         for spawnpoint in self.spawnpoints:
-            self.gfx_manager.draw('spawnpoint', spawnpoint)
+            if in_viewport(spawnpoint):
+                layer.draw('spawnpoint', (spawnpoint[0] - left,
+                                          spawnpoint[1] - top),
+                           True, (0, 0))
 
         for portal in list(self.portals.values()):
-            self.gfx_manager.draw('portal', portal[0])
+            if in_viewport(portal[0]):
+                layer.draw('portal', (portal[0][0] - left,
+                                      portal[0][1] - top), True, (0, 0))
+
+        return layer
+
+    def invalidate(self):
+        """
+        Discard the pre-rendered layer after the map was edited. The
+        edited map no longer shares derived data with its file, and
+        caches keyed on the version of the map miss from now on.
+        """
+        self.version += 1
+        self.layer = None
+        self.map_entry = None
+        self._landmarks = None
+
+    def draw(self, gfx_manager, offset=(0, 0), viewport=None):
+        """
+        Draw tile map, rendering it first if necessary
+        :param gfx_manager: graphics manager to draw with
+        :param offset: offset of the viewport on screen
+        :param viewport: see render
+        :return:
+        """
+        if (self.layer is None or
+                (viewport or self.get_full_viewport()) != self.viewport):
+            self.render(gfx_manager, viewport)
+
+        gfx_manager.blit_layer(self.layer, offset)
 
     def get_obj_type(self, pos):
         if pos in self.spawnpoints:
@@ -248,25 +512,83 @@ class TileMap(TileMapBase):
     """
     Extends BaseTileMap with functions for in game use
     """
-    def __init__(self, game, filepath):
-        self.game = game
-        TileMapBase.__init__(self, game.graphics, filepath)
+    def __init__(self, sim, filepath):
+        self.sim = sim
+        TileMapBase.__init__(self, filepath)
 
     def get_spawnpoint(self):
-        """Return  random, unblocked spawnpoint."""
+        """
+        Return a random, unblocked spawnpoint. If all of them are
+        blocked, return the free cell closest to a spawnpoint which has
+        no snake nearby.
+        """
         unblocked_sp = [spawnpoint for spawnpoint in self.spawnpoints if
                         self.sp_unblocked(spawnpoint)]
-        return self.game.randomizer.choice(unblocked_sp)
+
+        if unblocked_sp:
+            return self.sim.randomizer.choice(unblocked_sp)
+
+        pos = self.find_spawn_cell()
+
+        if pos is None:
+            raise RuntimeError('no room to spawn a snake')
+
+        return pos
+
+    def find_spawn_cell(self):
+        """
+        Search breadth-first from the spawnpoints for a cell a snake can
+        spawn on, see is_spawn_cell.
+        :return: the cell or None if there is none
+        """
+        grid = self.sim.grid
+        spawnpoints = list(self.spawnpoints)
+        self.sim.randomizer.shuffle(spawnpoints)
+        seen = set(spawnpoints)
+        queue = deque(spawnpoints)
+
+        while queue:
+            pos = queue.popleft()
+
+            if self.is_spawn_cell(pos):
+                return pos
+
+            for heading in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+                adj = self.wrap_around((pos[0] + heading[0],
+                                        pos[1] + heading[1]))
+
+                if adj not in seen and not grid.is_wall(adj):
+                    seen.add(adj)
+                    queue.append(adj)
+
+        return None
+
+    def is_spawn_cell(self, pos):
+        """
+        Determine if a snake can spawn at pos: both cells of its body,
+        pos and the cell east of it, are free and no other snake is
+        within SPAWN_CLEARANCE cells.
+        """
+        grid = self.sim.grid
+
+        if not (grid.is_free(pos) and
+                grid.is_free(self.wrap_around((pos[0] + 1, pos[1])))):
+            return False
+
+        for d_x in range(-SPAWN_CLEARANCE, SPAWN_CLEARANCE + 2):
+            for d_y in range(-SPAWN_CLEARANCE, SPAWN_CLEARANCE + 1):
+                near = ((pos[0] + d_x) % self.width,
+                        (pos[1] + d_y) % self.height)
+
+                if grid.get_flags(near) & SNAKE_CELL:
+                    return False
+
+        return True
 
     def sp_unblocked(self, spawnpoint):
         """Determine if a spawnpoint is blocked."""
-        return len(self.game.current_state.mode.spatialhash[spawnpoint]) == 1
+        return self.sim.grid.get_flags(spawnpoint) == SPAWNPOINT_CELL
 
     def randpos(self):
-        """Return random position."""
-        while True:
-            pos = (self.game.randomizer.randint(1, COLS-1),
-                   self.game.randomizer.randint(1, ROWS-1))
-            if (pos not in self.game.current_state.mode.spatialhash and
-                    pos not in self.tiles):
-                return pos
+        """Return a random free position, or None if the map is full."""
+        return self.sim.grid.get_random_free(self.sim.randomizer)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+Process-wide cache of map files. Maps are keyed by their path and the
+SHA-1 digest of their content, so starting another match on the same
+map neither reparses the file nor derives its island labels, step costs
+or landmark tables again, while a map saved in the meantime is loaded
+afresh.
+
+Derived arrays are also stored in a sidecar file next to the map and
+loaded from there if the map hasn't changed, so a second launch skips
+the derivation as well. Arrays are only read from the sidecar file once
+they are asked for.
+"""
+
+import os
+import sys
+import struct
+import hashlib
+from array import array
+
+from utils import LRUCache, atomic_write
+
+MAP_CACHE_SIZE = 8
+SIDECAR_EXT = '.derived'
+SIDECAR_MAGIC = b'BSDRV'
+SIDECAR_VERSION = 1
+# magic, version, map digest, number of arrays
+SIDECAR_HEADER = struct.Struct('<5sB20sB')
+# name, type code, number of items
+ARRAY_HEADER = struct.Struct('<16scI')
+
+
+def map_digest(filepath):
+    """Return the SHA-1 digest of a map file."""
+    sha1 = hashlib.sha1()
+
+    with open(filepath, 'rb') as map_file:
+        for chunk in iter(lambda: map_file.read(65536), b''):
+            sha1.update(chunk)
+
+    return sha1.digest()
+
+
+class MapEntry(object):
+    """
+    Parsed data of a map file and the artifacts derived from it. Both
+    are shared by all tile maps loaded from the file, so don't modify
+    them.
+    :param use_sidecar: if False, the sidecar file is neither read nor
+    written
+    """
+
+    def __init__(self, filepath, digest, data, use_sidecar=True):
+        self.filepath = filepath
+        self.digest = digest
+        self.data = data
+        self.use_sidecar = use_sidecar
+        self.derived = {}
+        # Names of the derived arrays stored in the sidecar file
+        self.persistent = set()
+        # Arrays in the sidecar file not read yet, by name, as type
+        # code, offset and number of items
+        self.stored = {}
+
+    @property
+    def sidecar_path(self):
+        return self.filepath + SIDECAR_EXT
+
+    def get(self, name, build, persist=False):
+        """
+        Return the artifact called name, building it on first use.
+        :param persist: if True, the artifact is an array which is
+        stored in the sidecar file
+        """
+        value = self.derived.get(name)
+
+        if value is None and name in self.stored:
+            value = self.read_array(name)
+
+        if value is None:
+            value = self.derived[name] = build()
+
+            if persist:
+                self.persistent.add(name)
+
+                if self.use_sidecar:
+                    self.write_sidecar()
+
+        return value
+
+    def write_sidecar(self):
+        """Try to write the persistent arrays to the sidecar file."""
+        for name in list(self.stored):
+            self.read_array(name)
+
+        try:
+            with atomic_write(self.sidecar_path) as sidecar:
+                sidecar.write(SIDECAR_HEADER.pack(
+                    SIDECAR_MAGIC, SIDECAR_VERSION, self.digest,
+                    len(self.persistent)))
+
+                for name in sorted(self.persistent):
+                    values = self.derived[name]
+                    sidecar.write(ARRAY_HEADER.pack(
+                        name.encode('ascii'), values.typecode.encode('ascii'),
+                        len(values)))
+
+                    if sys.byteorder == 'big' and values.itemsize > 1:
+                        values = array(values.typecode, values)
+                        values.byteswap()
+
+                    values.tofile(sidecar)
+        except (IOError, OSError):
+            pass
+
+    def read_sidecar(self):
+        """
+        Index the persistent arrays in the sidecar file, unless it is
+        missing or doesn't belong to the map.
+        """
+        stored = {}
+
+        try:
+            with open(self.sidecar_path, 'rb') as sidecar:
+                count = self._read_header(sidecar)
+
+                if count is None:
+                    return
+
+                size = os.fstat(sidecar.fileno()).st_size
+
+                for _ in range(count):
+                    name, typecode, length = ARRAY_HEADER.unpack(
+                        sidecar.read(ARRAY_HEADER.size))
+                    typecode = typecode.decode('ascii')
+                    offset = sidecar.tell()
+                    end = offset + length * array(typecode).itemsize
+
+                    if end > size:
+                        return
+
+                    stored[name.rstrip(b'\0').decode('ascii')] = (
+                        typecode, offset, length)
+                    sidecar.seek(end)
+        except (IOError, OSError, struct.error, ValueError):
+            return
+
+        self.stored.update(stored)
+        self.persistent.update(stored)
+
+    def _read_header(self, sidecar):
+        """
+        Return the number of arrays in the sidecar file, or None if it
+        doesn't belong to the map.
+        """
+        header = sidecar.read(SIDECAR_HEADER.size)
+
+        if len(header) < SIDECAR_HEADER.size:
+            return None
+
+        magic, version, digest, count = SIDECAR_HEADER.unpack(header)
+
+        if (magic != SIDECAR_MAGIC or version != SIDECAR_VERSION or
+                digest != self.digest):
+            return None
+
+        return count
+
+    def read_array(self, name):
+        """
+        Read an indexed array from the sidecar file.
+        :return: the array or None if the file has changed since
+        """
+        typecode, offset, length = self.stored.pop(name)
+        values = array(typecode)
+
+        try:
+            with open(self.sidecar_path, 'rb') as sidecar:
+                if self._read_header(sidecar) is None:
+                    values = None
+                else:
+                    sidecar.seek(offset)
+                    values.fromfile(sidecar, length)
+        except (IOError, OSError, EOFError):
+            values = None
+
+        if values is None:
+            self.persistent.discard(name)
+            return None
+
+        if sys.byteorder == 'big' and values.itemsize > 1:
+            values.byteswap()
+
+        self.derived[name] = values
+        return values
+
+
+class MapCache(object):
+    """
+    Holds the entries of the most recently loaded map files.
+    :param use_sidecars: if False, no sidecar files are read or written
+    """
+
+    def __init__(self, maxsize=MAP_CACHE_SIZE, use_sidecars=True):
+        self.use_sidecars = use_sidecars
+        self._entries = LRUCache(maxsize)
+
+    @property
+    def hits(self):
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        return self._entries.misses
+
+    def get(self, filepath, loader):
+        """
+        Return the entry of a map file, loading it on first use or
+        after the file has changed.
+        :param loader: function parsing the file into a dict
+        """
+        digest = map_digest(filepath)
+        key = (os.path.abspath(filepath), digest)
+        entry = self._entries.get(key)
+
+        if entry is None:
+            entry = MapEntry(filepath, digest, loader(filepath),
+                             self.use_sidecars)
+
+            if self.use_sidecars:
+                entry.read_sidecar()
+
+            self._entries.put(key, entry)
+
+        return entry
+
+    def clear(self):
+        """Drop all entries, e.g. to free memory."""
+        self._entries.clear()
+
+
+map_cache = MapCache()
+
+
+def get_derived(tilemap, name, build, persist=False):
+    """
+    Return an artifact derived from a tile map, shared with all tile
+    maps loaded from the same file. Tile maps which weren't loaded from
+    a file or were edited since get their own.
+    """
+    if tilemap.map_entry is None:
+        return build()
+
+    return tilemap.map_entry.get(name, build, persist)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+Array backed occupancy grid holding type flags and owner ids for every
+cell of the map. Cells are addressed by flat integer indices, which
+makes reads O(1) without hashing position tuples. An index of the free
+cells is kept up to date, so picking a random free cell is O(1) too.
+"""
+
+from array import array
+
+# Cell flags
+WALL_CELL = 0x01
+PORTAL_CELL = 0x02
+SPAWNPOINT_CELL = 0x04
+HEAD_CELL = 0x08
+BODY_CELL = 0x10
+SHOT_CELL = 0x20
+PWRUP_CELL = 0x40
+
+SNAKE_CELL = HEAD_CELL | BODY_CELL
+
+NO_OWNER = -1
+# Slot of cells which aren't free
+NOT_FREE = -1
+
+
+class OccupancyGrid(object):
+    """
+    COLS x ROWS grid of cell flags and owner ids. Walls are static,
+    everything else is set by the spatial hash whenever the entries of
+    a cell change.
+
+    The free cells, without any flags, are listed in free_cells. The
+    slot of every cell in that list is held in free_slots, so cells are
+    added and swap-removed in O(1).
+    """
+    def __init__(self, cols, rows, walls=()):
+        self.cols = cols
+        self.rows = rows
+        self.size = cols * rows
+        self.static_flags = bytearray(self.size)
+
+        for pos in walls:
+            self.static_flags[self.index(pos)] = WALL_CELL
+
+        self.flags = bytearray(self.static_flags)
+        self._no_owners = array('h', [NO_OWNER]) * self.size
+        self.owners = array('h', self._no_owners)
+        # Indices of cells a snake entered or left since the last reset
+        self.changed_snake_cells = set()
+
+        self._static_free_cells = array(
+            'l', (index for index, flags in enumerate(self.static_flags)
+                  if not flags))
+        self._static_free_slots = array('l', [NOT_FREE]) * self.size
+
+        for slot, index in enumerate(self._static_free_cells):
+            self._static_free_slots[index] = slot
+
+        self.free_cells = array('l', self._static_free_cells)
+        self.free_slots = array('l', self._static_free_slots)
+
+    def index(self, pos):
+        """Return the flat index of pos."""
+        return pos[1] * self.cols + pos[0]
+
+    def pos(self, index):
+        """Return the position of a flat index."""
+        return index % self.cols, index // self.cols
+
+    def clear(self):
+        """Reset all cells to their static flags."""
+        self.flags[:] = self.static_flags
+        self.owners[:] = self._no_owners
+        self.changed_snake_cells = set()
+        self.free_cells = array('l', self._static_free_cells)
+        self.free_slots[:] = self._static_free_slots
+
+    def set_cell(self, index, flags, owner=NO_OWNER):
+        """Set the dynamic flags and the owner of a cell."""
+        flags |= self.static_flags[index]
+
+        if (flags ^ self.flags[index]) & SNAKE_CELL:
+            self.changed_snake_cells.add(index)
+
+        if not flags and self.flags[index]:
+            self.free_slots[index] = len(self.free_cells)
+            self.free_cells.append(index)
+        elif flags and not self.flags[index]:
+            # Move the last free cell into the slot of index
+            slot = self.free_slots[index]
+            last = self.free_cells.pop()
+
+            if last != index:
+                self.free_cells[slot] = last
+                self.free_slots[last] = slot
+
+            self.free_slots[index] = NOT_FREE
+
+        self.flags[index] = flags
+        self.owners[index] = owner
+
+    def get_flags(self, pos):
+        """Return the flags of the cell at pos."""
+        return self.flags[pos[1] * self.cols + pos[0]]
+
+    def get_owner(self, pos):
+        """Return the owner id of the cell at pos."""
+        return self.owners[pos[1] * self.cols + pos[0]]
+
+    def is_wall(self, pos):
+        """Determine if there's a wall at pos."""
+        return self.static_flags[pos[1] * self.cols + pos[0]] & WALL_CELL
+
+    def is_free(self, pos):
+        """Determine if nothing at all is located at pos."""
+        return not self.flags[pos[1] * self.cols + pos[0]]
+
+    def get_random_free(self, randomizer):
+        """Return a random free position, or None if there is none."""
+        if not self.free_cells:
+            return None
+
+        return self.pos(self.free_cells[
+            randomizer.randrange(len(self.free_cells))])
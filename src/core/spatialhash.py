@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent spatial hash which is updated incrementally by the entities
+moving on the map instead of being rebuilt every tick.
+"""
+
+from constants import SPAWNPOINT_TAG, PORTAL_TAG, SHOT_TAG, PWRUP_TAG
+from core.occupancy import (NO_OWNER, SPAWNPOINT_CELL, PORTAL_CELL,
+                            SHOT_CELL, PWRUP_CELL)
+
+
+class SpatialHash(object):
+    """
+    Maps grid positions to lists of (tag, obj) entries. Only occupied
+    positions are stored, so 'pos in spatialhash' tells whether
+    anything is located at pos.
+
+    Positions holding more than one entry are tracked in 'contested',
+    so collisions can be found without scanning every occupied cell.
+
+    If an occupancy grid is given, the flags and the owner of a cell are
+    kept in sync with its entries. Tags have to be registered for that.
+    """
+    def __init__(self, grid=None):
+        self._cells = {}
+        self.contested = set()
+        self.grid = grid
+        self.tag_info = {}
+
+        self.register_tag(SPAWNPOINT_TAG, SPAWNPOINT_CELL)
+        self.register_tag(PORTAL_TAG, PORTAL_CELL)
+        self.register_tag(SHOT_TAG, SHOT_CELL)
+        self.register_tag(PWRUP_TAG, PWRUP_CELL)
+
+    def register_tag(self, tag, flag, owner=NO_OWNER):
+        """Register the cell flag and owner id of a tag."""
+        self.tag_info[tag] = (flag, owner)
+
+    def insert(self, pos, tag, obj):
+        """Insert an entry at pos."""
+        entries = self._cells.get(pos)
+
+        if entries is None:
+            entries = self._cells[pos] = [(tag, obj)]
+        else:
+            entries.append((tag, obj))
+            self.contested.add(pos)
+
+        self._update_grid(pos, entries)
+
+    def remove(self, pos, tag, obj):
+        """
+        Remove an entry from pos.
+        :return: True if the entry has been found
+        """
+        entries = self._cells.get(pos)
+
+        if entries is None:
+            return False
+
+        for index, (entry_tag, entry_obj) in enumerate(entries):
+            if entry_tag == tag and entry_obj is obj:
+                del entries[index]
+
+                if not entries:
+                    del self._cells[pos]
+                elif len(entries) == 1:
+                    self.contested.discard(pos)
+
+                self._update_grid(pos, entries)
+
+                return True
+
+        return False
+
+    def move(self, old_pos, new_pos, tag, obj):
+        """Move an entry from old_pos to new_pos."""
+        self.remove(old_pos, tag, obj)
+        self.insert(new_pos, tag, obj)
+
+    def retag(self, pos, old_tag, new_tag, obj):
+        """Change the tag of an entry at pos."""
+        self.remove(pos, old_tag, obj)
+        self.insert(pos, new_tag, obj)
+
+    def clear(self):
+        """Remove all entries."""
+        self._cells.clear()
+        self.contested.clear()
+
+        if self.grid is not None:
+            self.grid.clear()
+
+    def _update_grid(self, pos, entries):
+        """Write the flags and the owner of pos to the grid."""
+        if self.grid is None:
+            return
+
+        flags = 0
+        owner = NO_OWNER
+
+        for tag, _ in entries:
+            tag_flag, tag_owner = self.tag_info.get(tag, (0, NO_OWNER))
+            flags |= tag_flag
+
+            if tag_owner != NO_OWNER:
+                owner = tag_owner
+
+        self.grid.set_cell(self.grid.index(pos), flags, owner)
+
+    def values(self):
+        """Return the entry lists of all occupied positions."""
+        return self._cells.values()
+
+    def __getitem__(self, pos):
+        return self._cells.get(pos, ())
+
+    def __contains__(self, pos):
+        return pos in self._cells
+
+    def __len__(self):
+        return len(self._cells)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""
+Chunked storage of map tiles. Big maps are mostly empty, so the tiles
+are kept in square chunks which are only allocated once a tile in them
+is set. Cells of unallocated chunks hold tile 0, no tile.
+"""
+
+from array import array
+
+CHUNK_SIZE = 32
+
+
+class TileStore(object):
+    """
+    Tiles of a cols x rows map, indexed by (x, y) positions. Tiles are
+    ints from 0 to 0xFFFF.
+    """
+
+    def __init__(self, cols, rows, chunk_size=CHUNK_SIZE):
+        self.cols = cols
+        self.rows = rows
+        self.chunk_size = chunk_size
+        # (chunk x, chunk y) -> tiles of the chunk, row by row
+        self.chunks = {}
+
+    def _locate(self, pos):
+        """Return the key of the chunk of pos and the index within it."""
+        size = self.chunk_size
+        pos_x, pos_y = pos
+        return ((pos_x // size, pos_y // size),
+                (pos_y % size) * size + pos_x % size)
+
+    def __getitem__(self, pos):
+        key, index = self._locate(pos)
+        chunk = self.chunks.get(key)
+        return chunk[index] if chunk is not None else 0
+
+    def __setitem__(self, pos, tile):
+        key, index = self._locate(pos)
+        chunk = self.chunks.get(key)
+
+        if chunk is None:
+            if not tile:
+                return
+            chunk = array('H', [0]) * self.chunk_size ** 2
+            self.chunks[key] = chunk
+
+        chunk[index] = tile
+
+    def __contains__(self, pos):
+        """Determine if there is a tile at pos."""
+        return (0 <= pos[0] < self.cols and 0 <= pos[1] < self.rows and
+                self[pos] != 0)
+
+    def __eq__(self, other):
+        if not isinstance(other, TileStore):
+            return NotImplemented
+
+        # Allocated chunks without tiles equal unallocated ones
+        def used_chunks(store):
+            return {key: chunk for key, chunk in store.chunks.items()
+                    if any(chunk)}
+
+        return ((self.cols, self.rows, self.chunk_size) ==
+                (other.cols, other.rows, other.chunk_size) and
+                used_chunks(self) == used_chunks(other))
+
+    def copy(self):
+        """Return a copy which doesn't share any chunks."""
+        store = TileStore(self.cols, self.rows, self.chunk_size)
+        store.chunks = {key: array('H', chunk)
+                        for key, chunk in self.chunks.items()}
+        return store
+
+    def get_chunk_rect(self, key):
+        """Return the cells x, y, width, height of a chunk in the map."""
+        size = self.chunk_size
+        pos_x, pos_y = key[0] * size, key[1] * size
+        return (pos_x, pos_y, min(size, self.cols - pos_x),
+                min(size, self.rows - pos_y))
+
+    def clip(self, rect=None):
+        """
+        Return the part of rect inside the map.
+        :param rect: cells x, y, width, height or None for the whole map
+        """
+        if rect is None:
+            return 0, 0, self.cols, self.rows
+
+        pos_x, pos_y, width, height = rect
+        left, top = max(pos_x, 0), max(pos_y, 0)
+        return (left, top,
+                max(min(pos_x + width, self.cols) - left, 0),
+                max(min(pos_y + height, self.rows) - top, 0))
+
+    def iter_chunk_keys(self, rect=None):
+        """
+        Iterate over the keys of the chunks intersecting rect, allocated
+        or not.
+        :param rect: see clip
+        """
+        size = self.chunk_size
+        left, top, width, height = self.clip(rect)
+
+        if not width or not height:
+            return
+
+        for chunk_y in range(top // size, (top + height - 1) // size + 1):
+            for chunk_x in range(left // size,
+                                 (left + width - 1) // size + 1):
+                yield chunk_x, chunk_y
+
+    def iter_tiles(self, rect=None):
+        """
+        Iterate over the positions and tiles of the cells in rect, chunk
+        by chunk. Cells of unallocated chunks have tile 0.
+        :param rect: see clip
+        """
+        size = self.chunk_size
+        left, top, width, height = rect = self.clip(rect)
+
+        for key in self.iter_chunk_keys(rect):
+            chunk = self.chunks.get(key)
+            chunk_x, chunk_y = key[0] * size, key[1] * size
+            cols = range(max(left, chunk_x),
+                         min(left + width, chunk_x + size))
+
+            for pos_y in range(max(top, chunk_y),
+                               min(top + height, chunk_y + size)):
+                if chunk is None:
+                    for pos_x in cols:
+                        yield (pos_x, pos_y), 0
+                    continue
+
+                offset = (pos_y - chunk_y) * size - chunk_x
+
+                for pos_x in cols:
+                    yield (pos_x, pos_y), chunk[offset + pos_x]
+
+    def get_row(self, pos_y):
+        """Return the tiles of a row as a list."""
+        size = self.chunk_size
+        chunk_y, offset = divmod(pos_y, size)
+        offset *= size
+        row = []
+
+        for chunk_x in range(0, (self.cols + size - 1) // size):
+            width = min(size, self.cols - chunk_x * size)
+            chunk = self.chunks.get((chunk_x, chunk_y))
+
+            if chunk is None:
+                row.extend([0] * width)
+            else:
+                row.extend(chunk[offset:offset + width])
+
+        return row
+
+    def set_row(self, pos_y, tiles):
+        """Set the tiles of a row, allocating only chunks with tiles."""
+        size = self.chunk_size
+        chunk_y, offset = divmod(pos_y, size)
+        offset *= size
+
+        for chunk_x in range(0, (self.cols + size - 1) // size):
+            values = tiles[chunk_x * size:(chunk_x + 1) * size]
+            chunk = self.chunks.get((chunk_x, chunk_y))
+
+            if chunk is None:
+                if not any(values):
+                    continue
+                chunk = array('H', [0]) * size ** 2
+                self.chunks[chunk_x, chunk_y] = chunk
+
+            chunk[offset:offset + len(values)] = array('H', values)
+
+    def max_tile(self):
+        """Return the highest tile of the map."""
+        return max((max(chunk) for chunk in self.chunks.values()),
+                   default=0)
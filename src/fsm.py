@@ -28,6 +28,10 @@ class State(metaclass=ABCMeta):
 
 
 class GameState(State, metaclass=ABCMeta):
+    # Static layer and its offset on screen to restore areas from
+    # between frames. None redraws the whole screen every frame.
+    background = None
+
     def __init__(self, game):
         self.game = game
         
@@ -105,10 +105,12 @@ class PlayingState(GameState):
     def __init__(self, game, mode):
         GameState.__init__(self, game)
         self.mode = mode
-        # FIXME: This really necessary?
-        self.game.tilemap = mode.tilemap
         self.mode.start()
 
+    @property
+    def background(self):
+        return self.mode.background
+
     def update(self, delta_time):
         self.mode.update(delta_time)
 
@@ -339,6 +339,7 @@ class TextDisplay(WidgetBase):
     def __init__(self, game, **kwargs):
         WidgetBase.__init__(self, game, **kwargs)
         self.text = kwargs.get('text', '')
+        self.wrapped = (None, None, [])
 
     def set_text(self, text):
         self.text = text
@@ -350,7 +351,13 @@ class TextDisplay(WidgetBase):
 
         xpos, ypos = add_vecs(pos,
                               (self.brd_thickness, self.brd_thickness))
-        for line in textwrap.wrap(self.text, width=num_chars):
+        # Only wrap the text again if it or the width has changed
+        text, chars, lines = self.wrapped
+        if text != self.text or chars != num_chars:
+            lines = textwrap.wrap(self.text, width=num_chars)
+            self.wrapped = (self.text, num_chars, lines)
+
+        for line in lines:
             self.game.graphics.draw_string((xpos, ypos), line, WHITE)
             ypos += self.game.graphics.get_height()
 
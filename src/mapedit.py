@@ -24,10 +24,6 @@ import editor.tools
 FPS = 30
 
 CELL_SIZE = 10
-ROWS = 64
-COLS = 128
-DISPLAY_WIDTH = COLS * CELL_SIZE
-DISPLAY_HEIGHT = ROWS * CELL_SIZE
 
 LEFT_MOUSE_BUTTON = 1
 RIGHT_MOUSE_BUTTON = 3
@@ -40,10 +36,18 @@ SPAWNPOINT_OBJ = 1
 PORTAL_OBJ = 2
 BLOCKED_OBJ = 3
 
+# Tile painted by the tile tool
+DEFAULT_TILE = 1
+
 DEFAULT_EXT = '.battle-snakes.map'
 DEFAULT_INIT_DIR = os.path.expanduser('~')
 
 
+def get_cell(point):
+    """Return the grid cell of a point on the display."""
+    return int(point[0]) // CELL_SIZE, int(point[1]) // CELL_SIZE
+
+
 def gen_tile_line(point1, point2):
     """
     Generates a line of tiles from point1 to point2
@@ -129,7 +133,8 @@ class TileTool(object):
             self.startpoint = self.editor.selected
 
         if self.editor.input.button_pressed(LEFT_MOUSE_BUTTON) and \
-                self.editor.selected not in self.editor.tilemap.tiles \
+                get_cell(self.editor.selected) not in \
+                self.editor.tilemap.tiles \
                 and not self.editor.input.key_pressed('SHIFT_L') \
                 and not self.editor.input.key_pressed('CONTROL_L'):
 
@@ -144,7 +149,7 @@ class TileTool(object):
             self.startpoint = None
 
         if (self.editor.input.button_pressed(RIGHT_MOUSE_BUTTON) and
-                self.editor.selected in self.editor.tilemap.tiles):
+                get_cell(self.editor.selected) in self.editor.tilemap.tiles):
 
             cmd = EditMapCommand(
                 [self.editor.selected],
@@ -177,7 +182,7 @@ class TileTool(object):
 
     def fill_horizontal(self):
         tile_lst = gen_tile_line((0, self.editor.selected[1]),
-                                      (DISPLAY_WIDTH,
+                                      (self.editor.display_size[0],
                                        self.editor.selected[1]))
 
         cmd = EditMapCommand(tile_lst, self.editor.tilemap, TILE_OBJ)
@@ -186,14 +191,14 @@ class TileTool(object):
     def fill_vertical(self):
         tile_lst = gen_tile_line((self.editor.selected[0], 0),
                                       (self.editor.selected[0],
-                                       DISPLAY_HEIGHT))
+                                       self.editor.display_size[1]))
 
         cmd = EditMapCommand(tile_lst, self.editor.tilemap, TILE_OBJ)
         self.editor.cmd_manager.exec_cmd(cmd)
 
     def remove_horizontal(self):
         tile_lst = gen_tile_line((0, self.editor.selected[1]),
-                                      (DISPLAY_WIDTH,
+                                      (self.editor.display_size[0],
                                        self.editor.selected[1]))
 
         cmd = EditMapCommand(tile_lst,
@@ -205,7 +210,7 @@ class TileTool(object):
     def remove_vertical(self):
         tile_lst = gen_tile_line((self.editor.selected[0], 0),
                                       (self.editor.selected[0],
-                                       DISPLAY_HEIGHT))
+                                       self.editor.display_size[1]))
 
         cmd = EditMapCommand(tile_lst, self.editor.tilemap, TILE_OBJ,
                              remove=True)
@@ -295,14 +300,20 @@ class CommandManager(object):
 
 
 class EditMapCommand(object):
-    def __init__(self, obj_lst, tilemap, obj_type, remove=False):
+    def __init__(self, obj_lst, tilemap, obj_type, remove=False,
+                 tile=DEFAULT_TILE):
         self.obj_lst = obj_lst
         self.tilemap = tilemap
         self.obj_type = obj_type
         self.objs_changed = []
         self.remove = remove
+        self.tile = tile
 
     def do(self):
+        if self.obj_type == TILE_OBJ:
+            self.set_tiles(0 if self.remove else self.tile)
+            return
+
         for obj in self.obj_lst:
             if self.remove:
                 if obj in self.tilemap[self.obj_type]:
@@ -314,6 +325,11 @@ class EditMapCommand(object):
                     self.objs_changed.append(obj)
 
     def undo(self):
+        if self.obj_type == TILE_OBJ:
+            for pos, tile in self.objs_changed:
+                self.tilemap.tiles[pos] = tile
+            return
+
         for obj in self.objs_changed:
             if self.remove:
                 if self.tilemap.get_free(obj):
@@ -322,6 +338,26 @@ class EditMapCommand(object):
                 if obj in self.tilemap[self.obj_type]:
                     self.tilemap[self.obj_type].remove(obj)
 
+    def set_tiles(self, tile):
+        """
+        Set the tiles at the points of obj_lst, remembering the previous
+        ones for undo. Points off the map are skipped.
+        """
+        tiles = self.tilemap.tiles
+        self.objs_changed = []
+
+        for point in self.obj_lst:
+            pos = get_cell(point)
+
+            if (not (0 <= pos[0] < self.tilemap.width and
+                     0 <= pos[1] < self.tilemap.height) or
+                    tiles[pos] == tile):
+                continue
+
+            if self.remove or self.tilemap.is_unblocked(pos):
+                self.objs_changed.append((pos, tiles[pos]))
+                tiles[pos] = tile
+
 
 class InputManager(object):
     def __init__(self, init_mouse_x=0, init_mouse_y=0):
@@ -406,8 +442,9 @@ class InputManager(object):
 
 class MapEditor(object):
     def __init__(self):
-        self.input = InputManager(DISPLAY_WIDTH / 2,
-                                  DISPLAY_HEIGHT / 2)
+        self.tilemap = TileMapBase()
+        self.input = InputManager(self.display_size[0] // 2,
+                                  self.display_size[1] // 2)
 
         self.root = tk.Tk()
 
@@ -507,8 +544,7 @@ class MapEditor(object):
         self.root.update()
         self.fps_clock = pygame.time.Clock()
         pygame.init()
-        self.screen = pygame.display.set_mode((DISPLAY_WIDTH,
-                                               DISPLAY_HEIGHT))
+        self.screen = pygame.display.set_mode(self.display_size)
 
         self.cmd_manager = CommandManager()
         self.cmd_manager.state_change_listener.append(self.on_cmd_state_change)
@@ -518,8 +554,6 @@ class MapEditor(object):
 
         self.graphics = GraphicsManager(self.screen)
 
-        self.tilemap = TileMapBase(self.graphics)
-
         self.tile_textures = self.graphics.get_startswith('tile')
 
         # self.tool = TileTool(self)
@@ -532,6 +566,18 @@ class MapEditor(object):
 
         self.clipboard = None
 
+    @property
+    def display_size(self):
+        """Return the size of the map on the display in pixels."""
+        return (self.tilemap.width * CELL_SIZE,
+                self.tilemap.height * CELL_SIZE)
+
+    def set_tilemap(self, tilemap):
+        """Edit tilemap, resizing the display to its size."""
+        self.tilemap = tilemap
+        self.screen = pygame.display.set_mode(self.display_size)
+        self.graphics.surf = self.screen
+
     def yes_no(self):
         title = 'Quit mapedit'
         msg = 'Are you sure you want to discard unsaved changes?'
@@ -554,7 +600,7 @@ class MapEditor(object):
 
     def reset(self):
         self.cmd_manager.reset()
-        self.tilemap = TileMapBase(self.graphics)
+        self.set_tilemap(TileMapBase())
         self.unsaved_changes = False
         self.save_path = ''
 
@@ -565,6 +611,7 @@ class MapEditor(object):
         self.root.destroy()
 
     def on_cmd_state_change(self):
+        self.tilemap.invalidate()
         self.unsaved_changes = True
         self.state_change()
 
@@ -577,10 +624,9 @@ class MapEditor(object):
             self.file_menu.entryconfig(4, state=tk.DISABLED)
 
     def on_mouse_motion(self, pos):
-        left = COLS * CELL_SIZE
-        bot = ROWS * CELL_SIZE
-        xpos = pos[0] / CELL_SIZE if pos[0] < left else COLS-1
-        ypos = pos[1] / CELL_SIZE if pos[1] < bot else ROWS-1
+        cols, rows = self.tilemap.width, self.tilemap.height
+        xpos = min(pos[0] // CELL_SIZE, cols - 1)
+        ypos = min(pos[1] // CELL_SIZE, rows - 1)
         msg_str = 'pos: {0}:{1}'.format(xpos, ypos)
         self.label_tile_pos.config(text=msg_str)
 
@@ -598,7 +644,7 @@ class MapEditor(object):
             title='Open map')
 
         if result is not '':
-            self.tilemap = TileMapBase(self.graphics, result)
+            self.set_tilemap(TileMapBase(result))
 
     def save_map(self):
         self.tilemap.write_to_file(self.save_path)
@@ -665,11 +711,10 @@ class MapEditor(object):
             #     self.tool = SpawnpointTool(self)
 
         # Update selected cell
-        row = self.input.mouse_y / CELL_SIZE
-        col = self.input.mouse_x / CELL_SIZE
-        self.selected = (
-            (col if col < COLS else COLS - 1) * CELL_SIZE,
-            (row if row < ROWS else ROWS - 1) * CELL_SIZE)
+        row = self.input.mouse_y // CELL_SIZE
+        col = self.input.mouse_x // CELL_SIZE
+        self.selected = (min(col, self.tilemap.width - 1) * CELL_SIZE,
+                         min(row, self.tilemap.height - 1) * CELL_SIZE)
 
         self.tool.update()
 
@@ -679,15 +724,17 @@ class MapEditor(object):
     def draw(self):
         if self.grid_var.get():
             # Draw a grid
-            for pos_x in range(0, DISPLAY_WIDTH, CELL_SIZE):
+            width, height = self.display_size
+
+            for pos_x in range(0, width, CELL_SIZE):
                 pygame.draw.line(self.screen, GUN_METAL, (pos_x, 0),
-                                 (pos_x, DISPLAY_HEIGHT))
+                                 (pos_x, height))
 
-            for pos_y in range(0, DISPLAY_HEIGHT, CELL_SIZE):
+            for pos_y in range(0, height, CELL_SIZE):
                 pygame.draw.line(self.screen, GUN_METAL, (0, pos_y),
-                                 (DISPLAY_WIDTH, pos_y))
+                                 (width, pos_y))
 
-        self.tilemap.draw()
+        self.tilemap.draw(self.graphics)
 
         self.tool.draw(self.screen)
 
@@ -699,13 +746,13 @@ class MapEditor(object):
             half_size = CELL_SIZE / 2
 
             point1 = (self.selected[0] + half_size, 0)
-            point2 = (self.selected[0] + half_size, DISPLAY_HEIGHT)
+            point2 = (self.selected[0] + half_size, self.display_size[1])
 
             pygame.draw.line(self.screen, self.guide_line_color,
                              point1, point2)
 
             point1 = (0, self.selected[1] + half_size)
-            point2 = (DISPLAY_WIDTH, self.selected[1] + half_size)
+            point2 = (self.display_size[0], self.selected[1] + half_size)
 
             pygame.draw.line(self.screen, self.guide_line_color,
                              point1, point2)
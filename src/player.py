@@ -5,14 +5,16 @@ Player module.
 
 from collections import deque
 
-import pygame
-
 from snake import Snake, WEST, EAST, NORTH, SOUTH
 from utils import add_vecs
 from combat import Weapon, DUMMY
 from constants import (INIT_BOOST, MAX_BOOST, BOOST_COST, BOOST_GAIN,
-                       BOOST_SPEED, INIT_LIFES, MAX_LIFES, PORTAL_TAG,
-                       PWRUP_TAG, SHOT_TAG, MAX_HITPOINTS, WHITE, RED, ORANGE, BLUE)
+                       BOOST_SPEED, INIT_LIFES, MAX_LIFES, MAX_HITPOINTS,
+                       WHITE, RED, ORANGE, BLUE, TICK_RATE)
+
+# Boost cost and gain per tick
+TICK_BOOST_COST = BOOST_COST / float(TICK_RATE)
+TICK_BOOST_GAIN = BOOST_GAIN / float(TICK_RATE)
 
 
 class PlayerBase(object):
@@ -21,9 +23,9 @@ class PlayerBase(object):
     Player base class.
     """
 
-    def __init__(self, game_mode, dead_handler, **kwargs):
-        self.game = game_mode.game
-        self.tilemap = game_mode.tilemap
+    def __init__(self, sim, dead_handler, **kwargs):
+        self.sim = sim
+        self.tilemap = sim.tilemap
         self.pid = kwargs['id']
         self.color = kwargs['color']
         self.snake_skin = kwargs['skin']
@@ -37,13 +39,13 @@ class PlayerBase(object):
         self.dead_handler = dead_handler
         # TODO: Add weapons from kwargs
         self.weapons = deque(maxlen=5)
-        self.weapons.append(Weapon(game_mode.game, self, DUMMY))
+        self.weapons.append(Weapon(sim, self, DUMMY))
         self.pwrup_targets = {'points': 'points', 'grow': 'snake.grow',
                               'speed': 'snake.speed', 'boost': 'boost',
                               'lifes': 'lifes', 'hp': 'snake.hitpoints'}
 
     def start(self):
-        self.snake = Snake(self.game, self.tilemap.get_spawnpoint(),
+        self.snake = Snake(self.sim, self.tilemap.get_spawnpoint(),
                            self.snake_skin, self.pid,
                            self.snake_killed, self.snake_config)
 
@@ -77,36 +79,30 @@ class PlayerBase(object):
         else:
             self._boost = value
 
-    def coll_check_head(self, collobjs):
-        """Handle collisions for the snake's head."""
-        for tag, obj in collobjs:
-            if (tag.endswith('-body') or tag.endswith('-head')) and \
-                    tag != self.snake.head_tag:
-                obj.take_damage(35, self.snake.head_tag, False, True,
-                                0.7, shrink=1, slowdown=0.03)
-            elif tag == PORTAL_TAG:
-                self.snake.heading = obj[1]
-                self.snake[0] = add_vecs(obj[0], self.snake.heading)
-            elif tag == PWRUP_TAG:
-                for action in obj.actions:
-                    target = self.pwrup_targets[action['target']]
-                    if '.' in target:
-                        target1, target2 = target.split('.')
-                        attr = getattr(getattr(self, target1), target2)
-                        setattr(getattr(self, target1),
-                                target2, attr + action['value'])
-                    else:
-                        attr = getattr(self, target)
-                        setattr(self, target, attr + action['value'])
-                obj.collect()
-            elif tag == SHOT_TAG:
-                self.handle_shot(obj)
-
-    def coll_check_body(self, collobjs):
-        """Handle collisions for the snakes's body."""
-        for tag, obj in collobjs:
-            if tag == SHOT_TAG:
-                self.handle_shot(obj)
+    def hit_snake(self, snake):
+        """Handle the snake's head running into a snake."""
+        snake.take_damage(35, self.snake.head_tag, False, True,
+                          0.7, shrink=1, slowdown=0.03)
+
+    def enter_portal(self, portal):
+        """Handle the snake's head entering a portal."""
+        self.snake.heading = portal[1]
+        self.snake[0] = self.tilemap.wrap_around(
+            add_vecs(portal[0], self.snake.heading))
+
+    def collect_pwrup(self, pwrup):
+        """Handle the snake's head collecting a powerup."""
+        for action in pwrup.actions:
+            target = self.pwrup_targets[action['target']]
+            if '.' in target:
+                target1, target2 = target.split('.')
+                attr = getattr(getattr(self, target1), target2)
+                setattr(getattr(self, target1),
+                        target2, attr + action['value'])
+            else:
+                attr = getattr(self, target)
+                setattr(self, target, attr + action['value'])
+        pwrup.collect()
 
     def handle_shot(self, shot):
         """Handle shot."""
@@ -114,39 +110,38 @@ class PlayerBase(object):
                                slowdown=shot.slowdown, shrink=1)
         shot.hit()
 
-    def update(self, delta_time):
-        """Update player, move snake."""
+    def update(self):
+        """Advance player by one tick, move snake."""
         if not self.snake:
             return
 
-        self.snake.update(delta_time)
+        self.snake.update()
 
-        self.weapons[0].update(delta_time)
+        self.weapons[0].update()
 
         if self.snake.heading != self.snake.prev_heading:
             self.snake.ismoving = True
 
-        if self.boost < BOOST_COST * delta_time:
+        if self.boost < TICK_BOOST_COST:
             self.boosting = False
             self.snake.speed_bonus = 0
 
         if self.boosting:
-            boost = self.boost - BOOST_COST * delta_time
-            if boost < BOOST_COST * delta_time:
+            boost = self.boost - TICK_BOOST_COST
+            if boost < TICK_BOOST_COST:
                 self.boost = 0
             else:
                 self.boost = boost
         else:
-            self.boost = self.boost + BOOST_GAIN * delta_time
+            self.boost = self.boost + TICK_BOOST_GAIN
 
-    def draw(self, offset):
-        """Draw snake and UI."""
+    def draw(self, gfx, offset, cameras=(None,)):
+        """Draw snake in every camera and UI."""
         if not self.snake:
             return
 
-        self.snake.draw()
-
-        gfx = self.game.graphics
+        for camera in cameras:
+            self.snake.draw(gfx, camera)
 
         gfx.draw_string(add_vecs((2, 2), offset),
                         'Player{0}'.format(self.pid), self.color)
@@ -157,19 +152,15 @@ class PlayerBase(object):
         gfx.draw_string(add_vecs((2, 18), offset),
                         'Points: {0}'.format(self.points), WHITE)
 
-        pygame.draw.rect(self.game.screen, ORANGE,
-                         pygame.Rect(add_vecs((100, 2), offset),
-                                     (104, 20)))
+        gfx.draw_rect(ORANGE, add_vecs((100, 2), offset), (104, 20))
 
         # Draw life bar. TODO: Make this some kinda class.
         width = int(self.snake.hitpoints / float(MAX_HITPOINTS) * 100)
-        rect = pygame.Rect(add_vecs((102, 4), offset), (width, 7))
-        pygame.draw.rect(self.game.screen, RED, rect)
+        gfx.draw_rect(RED, add_vecs((102, 4), offset), (width, 7))
 
         if self.boost_enabled:
             width = int(self.boost / float(MAX_BOOST) * 100)
-            rect = pygame.Rect(add_vecs((102, 13), offset), (width, 7))
-            pygame.draw.rect(self.game.screen, BLUE, rect)
+            gfx.draw_rect(BLUE, add_vecs((102, 13), offset), (width, 7))
 
         gfx.draw_string(add_vecs((208, 2), offset),
                         '{0} {1}'.format(self.weapons[0].wtype,
@@ -195,12 +186,14 @@ class Player(PlayerBase):
     Player class.
     """
 
-    def __init__(self, game_mode, dead_handler, kwargs):
-        PlayerBase.__init__(self, game_mode, dead_handler, **kwargs)
+    def __init__(self, sim, dead_handler, kwargs, key_manager):
+        PlayerBase.__init__(self, sim, dead_handler, **kwargs)
 
-        self.game.key_manager.key_down_event.append(self.key_down)
-        self.game.key_manager.key_up_event.append(self.key_up)
+        self.key_manager = key_manager
+        self.key_manager.key_down_event.append(self.key_down)
+        self.key_manager.key_up_event.append(self.key_up)
         self.ctrls = kwargs['ctrls']
+        self.next_weapon = False
 
     def key_down(self, key):
         """Key down event handler."""
@@ -220,26 +213,30 @@ class Player(PlayerBase):
             self.snake.speed_bonus = 0
         elif key == self.ctrls['action']:
             self.weapons[0].set_firing(False)
+        elif key == self.ctrls['nextweapon']:
+            # Latched until the next tick, frames may run without ticks.
+            self.next_weapon = True
 
-    def update(self, delta_time):
+    def update(self):
         """Update player."""
 
-        PlayerBase.update(self, delta_time)
+        PlayerBase.update(self)
 
-        if self.game.key_manager.key_pressed(self.ctrls['left']) \
+        if self.key_manager.key_pressed(self.ctrls['left']) \
                 and self.snake.heading != EAST:
             self.snake.set_heading(WEST)
-        elif self.game.key_manager.key_pressed(self.ctrls['up']) \
+        elif self.key_manager.key_pressed(self.ctrls['up']) \
                 and self.snake.heading != SOUTH:
             self.snake.set_heading(NORTH)
-        elif self.game.key_manager.key_pressed(self.ctrls['down']) \
+        elif self.key_manager.key_pressed(self.ctrls['down']) \
                 and self.snake.heading != NORTH:
             self.snake.set_heading(SOUTH)
-        elif self.game.key_manager.key_pressed(self.ctrls['right']) \
+        elif self.key_manager.key_pressed(self.ctrls['right']) \
                 and self.snake.heading != WEST:
             self.snake.set_heading(EAST)
 
-        if self.game.key_manager.key_tapped(self.ctrls['nextweapon']):
+        if self.next_weapon:
+            self.next_weapon = False
             # FIXME: Dangerous...
             self.weapons.rotate(1)
             while self.weapons[0].ammo <= 0:
@@ -7,7 +7,9 @@ from functools import partial
 import itertools
 import xml.dom.minidom as dom
 
-from utils import Timer
+from utils import Timer, secs_to_ticks
+from constants import PWRUP_TAG
+from camera import get_offset
 
 
 class Powerup(object):
@@ -16,19 +18,20 @@ class Powerup(object):
     Represents a powerup.
     """
 
-    def __init__(self, game, pos, prototype):
-        self.game = game
+    def __init__(self, sim, pos, prototype):
+        self.sim = sim
         self.pos = pos
         self.elapsed_lifetime = 0
         self.elapsed_blink = 0
-        self.isalive = True
+        self.isalive = False
         self.isvisible = True
         self.tex = prototype['tex']
         self.actions = prototype['actions']
         self.pid = prototype['pid']
-        self.lifetime = prototype.get('lifetime', 100000)
-        self.blinkrate = prototype.get('blinkrate', 100000)
-        self.startblinkingat = prototype.get('startblinkingat', 100000)
+        self.lifetime = secs_to_ticks(prototype.get('lifetime', 100000))
+        self.blinkrate = secs_to_ticks(prototype.get('blinkrate', 100000))
+        self.startblinkingat = secs_to_ticks(
+            prototype.get('startblinkingat', 100000))
         self.autorespawn = prototype.get('autorespawn', False)
         self.reinit(pos, prototype)
 
@@ -39,17 +42,27 @@ class Powerup(object):
         self.tex = prototype['tex']
         self.actions = prototype['actions']
         self.pid = prototype['pid']
-        self.lifetime = prototype.get('lifetime', 100000)
-        self.blinkrate = prototype.get('blinkrate', 100000)
-        self.startblinkingat = prototype.get('startblinkingat', 100000)
+        self.lifetime = secs_to_ticks(prototype.get('lifetime', 100000))
+        self.blinkrate = secs_to_ticks(prototype.get('blinkrate', 100000))
+        self.startblinkingat = secs_to_ticks(
+            prototype.get('startblinkingat', 100000))
         self.autorespawn = prototype.get('autorespawn', False)
 
     def collect(self):
         """Tell the powerup that it has been collected."""
-        self.isalive = False
+        self.despawn()
+
+    def despawn(self):
+        """Remove powerup from the map."""
+        if self.isalive:
+            self.isalive = False
+            self.sim.spatialhash.remove(self.pos, PWRUP_TAG, self)
+            self.sim.pwrup_manager.on_despawn(self)
 
     def respawn(self, pos):
         """Respawn powerup."""
+        self.despawn()
+        self.sim.spatialhash.insert(pos, PWRUP_TAG, self)
         self.pos = pos
 
         self.elapsed_lifetime = 0
@@ -57,23 +70,23 @@ class Powerup(object):
         self.isalive = True
         self.isvisible = True
 
-    def update(self, delta_time):
-        """Update powerup."""
-        self.elapsed_lifetime += delta_time
+    def update(self):
+        """Advance powerup by one tick."""
+        self.elapsed_lifetime += 1
 
         if self.elapsed_lifetime >= self.lifetime:
-            self.isalive = False
+            self.despawn()
 
         if self.elapsed_lifetime >= self.startblinkingat:
-            self.elapsed_blink += delta_time
+            self.elapsed_blink += 1
             if self.elapsed_blink >= self.blinkrate:
                 self.elapsed_blink -= self.blinkrate
                 self.isvisible = not self.isvisible
 
-    def draw(self):
+    def draw(self, gfx, camera=None):
         """Draw powerup."""
         if self.isvisible:
-            self.game.graphics.draw(self.tex, self.pos)
+            gfx.draw(self.tex, self.pos, offset=get_offset(camera))
 
 
 class PowerupManager(object):
@@ -82,12 +95,13 @@ class PowerupManager(object):
     Powerup manager.
     """
 
-    def __init__(self, game):
-        self.game = game
+    def __init__(self, sim):
+        self.sim = sim
         self.pwrup_pool = []
         self.pwrup_spawners = []
         self.pwrup_prototypes = {}
         self.pid_counter = itertools.count()
+        self.despawn_event = []
 
         doc = dom.parse('../data/powerups.xml')
 
@@ -121,6 +135,12 @@ class PowerupManager(object):
         self.pwrup_pool = list()
         self.pwrup_spawners = list()
 
+    def on_despawn(self, pwrup):
+        """Invoke powerup despawn event."""
+        for event in self.despawn_event:
+            if event is not None:
+                event(pwrup)
+
     def get_powerups(self):
         """Return active powerups as tuple."""
         alive_pwrups = []
@@ -133,35 +153,45 @@ class PowerupManager(object):
 
     def autospawn(self, config, freq, delay=0):
         """Register a powerup so it will be spawned automatically."""
-        timer = Timer(1. / (freq / 60.),
-                      partial(self.spawn_pwrup, config), delay, True)
+        timer = Timer(secs_to_ticks(1. / (freq / 60.)),
+                      partial(self.spawn_pwrup, config),
+                      secs_to_ticks(delay), True)
         self.pwrup_spawners.append(timer)
 
     def spawn_pwrup(self, name, times=1):
         """Spawn powerup."""
         for _ in range(times):
+            pos = self.sim.tilemap.randpos()
+
+            # No room left on the map
+            if pos is None:
+                return
+
             for pwrup in self.pwrup_pool:
                 if not pwrup.isalive:
-                    pwrup.reinit(self.game.tilemap.randpos(),
-                                 self.pwrup_prototypes[name])
+                    pwrup.reinit(pos, self.pwrup_prototypes[name])
                     return
-            self.pwrup_pool.append(Powerup(self.game,
-                                           self.game.tilemap.randpos(),
+            self.pwrup_pool.append(Powerup(self.sim, pos,
                                            self.pwrup_prototypes[name]))
 
-    def update(self, delta_time):
+    def update(self):
         """Update powerups."""
         for pwrup_spawner in self.pwrup_spawners:
-            pwrup_spawner.update(delta_time)
+            pwrup_spawner.update()
 
         for pwrup in self.pwrup_pool:
             if pwrup.isalive:
-                pwrup.update(delta_time)
+                pwrup.update()
             elif pwrup.autorespawn:
-                pwrup.respawn(self.game.tilemap.randpos())
+                pos = self.sim.tilemap.randpos()
 
-    def draw(self):
-        """Draw powerups."""
+                # Try again next tick if the map is full
+                if pos is not None:
+                    pwrup.respawn(pos)
+
+    def draw(self, gfx, camera=None):
+        """Draw powerups, only those in view if a camera is given."""
         for pwrup in self.pwrup_pool:
-            if pwrup.isalive:
-                pwrup.draw()
+            if pwrup.isalive and (camera is None or
+                                  camera.contains(pwrup.pos)):
+                pwrup.draw(gfx, camera)
@@ -0,0 +1,296 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Headless simulation core. The simulation owns the tile map, players,
+shots and powerups of a match and advances them without touching
+pygame, so matches can be run without a display. Rendering is done by
+observers like the game modes which only read the simulation's state.
+
+The simulation advances in fixed ticks of 1 / TICK_RATE seconds and
+keeps all timers as integer tick counters, so a match played with the
+same seed and the same input is reproducible regardless of frame rate.
+"""
+
+import argparse
+import random
+
+from powerup import PowerupManager
+from combat import ShotManager
+from core.spatialhash import SpatialHash
+from core.occupancy import (OccupancyGrid, HEAD_CELL, BODY_CELL,
+                            PORTAL_CELL, PWRUP_CELL, SHOT_CELL)
+from bot import Bot
+from pathfinding import FlowFieldCache, PathCache
+from constants import (SPAWNPOINT_TAG, WALL_TAG, PORTAL_TAG, TICK_RATE,
+                       MAX_CATCHUP_TICKS)
+from utils import add_vecs, secs_to_ticks
+from core.map import TileMap
+
+DEFAULT_MAP = '../data/maps/test01.battle-snakes.map'
+DEFAULT_PWRUP = 'classic snake food'
+DEFAULT_SEED = 13
+
+
+class Simulation(object):
+
+    """
+    Game simulation, independent of any rendering or input.
+    """
+
+    def __init__(self, map_path, randomizer=None, game_over_handler=None):
+        self.randomizer = (randomizer if randomizer is not None
+                           else random.Random(DEFAULT_SEED))
+        self.tilemap = TileMap(self, map_path)
+        self.grid = OccupancyGrid(self.tilemap.width, self.tilemap.height,
+                                  self.tilemap.blocked)
+        self.spatialhash = SpatialHash(self.grid)
+        self.shot_manager = ShotManager(self)
+        self.pwrup_manager = PowerupManager(self)
+        self.flow_fields = FlowFieldCache(self.tilemap)
+        self.path_cache = PathCache(self.tilemap)
+        self.players = list()
+        self.player_ids = {}
+        self.num_dead_players = 0
+        self.ticks = 0
+        self.accumulator = 0.
+        self.game_over_handler = game_over_handler
+        self.step_event = []
+        self.cells_changed_event = []
+
+        self.pwrup_manager.despawn_event.append(self.pwrup_despawned)
+
+        # Collision handlers by the cell flags of the two entries
+        self.collision_handlers = {
+            (HEAD_CELL, HEAD_CELL): self.head_vs_snake,
+            (HEAD_CELL, BODY_CELL): self.head_vs_snake,
+            (HEAD_CELL, PORTAL_CELL): self.head_vs_portal,
+            (HEAD_CELL, PWRUP_CELL): self.head_vs_pwrup,
+            (HEAD_CELL, SHOT_CELL): self.snake_vs_shot,
+            (BODY_CELL, SHOT_CELL): self.snake_vs_shot,
+        }
+
+        self.insert_static()
+
+    @property
+    def is_over(self):
+        """Determine if all players are dead."""
+        return bool(self.players) and \
+            self.num_dead_players >= len(self.players)
+
+    def reset(self):
+        """Remove all players, shots and powerups."""
+        self.pwrup_manager.clear()
+        self.shot_manager.clear()
+        self.flow_fields.clear()
+        self.path_cache.clear()
+        # Listeners belong to the removed players
+        del self.cells_changed_event[:]
+        self.players = list()
+        self.player_ids = {}
+        self.num_dead_players = 0
+        self.ticks = 0
+        self.accumulator = 0.
+        self.spatialhash.clear()
+        self.insert_static()
+
+    def pwrup_despawned(self, pwrup):
+        """Powerup despawn event handler."""
+        self.flow_fields.evict(pwrup.pos)
+
+    def add_player(self, player):
+        """Add a player to the simulation."""
+        self.players.append(player)
+        self.player_ids[player.pid] = player
+
+    def player_dead(self):
+        """Player dead event handler."""
+        self.num_dead_players += 1
+
+        if self.is_over and self.game_over_handler is not None:
+            self.game_over_handler()
+
+    def start(self):
+        """Spawn the snakes of all players."""
+        for player in self.players:
+            player.start()
+
+    @property
+    def elapsed_t(self):
+        """Return simulated time in seconds."""
+        return self.ticks / float(TICK_RATE)
+
+    def step(self, delta_time):
+        """
+        Advance the simulation by delta_time seconds of real time.
+        Runs as many fixed ticks as fit into the accumulated time, but
+        at most MAX_CATCHUP_TICKS. Time beyond that is dropped, so a
+        long frame slows the game down instead of costing extra ticks.
+        :return: number of ticks run
+        """
+        self.accumulator += delta_time * TICK_RATE
+        ticks = min(int(self.accumulator), MAX_CATCHUP_TICKS)
+
+        if ticks == MAX_CATCHUP_TICKS:
+            self.accumulator = 0.
+        else:
+            self.accumulator -= ticks
+
+        for _ in range(ticks):
+            self.tick()
+
+        return ticks
+
+    def tick(self):
+        """Advance the simulation by a single tick."""
+        self.ticks += 1
+
+        self.pwrup_manager.update()
+        self.shot_manager.update()
+
+        for player in self.players:
+            player.update()
+
+        self.handle_collisions()
+
+        if self.grid.changed_snake_cells:
+            cells = self.grid.changed_snake_cells
+            self.grid.changed_snake_cells = set()
+
+            for event in self.cells_changed_event:
+                if event is not None:
+                    event(cells)
+
+        for event in self.step_event:
+            if event is not None:
+                event(self)
+
+    def handle_collisions(self):
+        """Handle collisions."""
+        for player in self.players:
+            if self.grid.is_wall(player.snake[0]):
+                player.snake.take_damage(20, WALL_TAG, True, True, 1,
+                                         shrink=0, slowdown=0.07)
+                break
+
+        for shot in self.shot_manager.shot_pool:
+            if not shot.isalive:
+                continue
+            if self.grid.is_wall(shot.pos):
+                shot.hit()
+            if shot.isalive and shot.pos in self.tilemap.portals:
+                shot.heading = self.tilemap.portals[shot.pos][1]
+                shot.move_to(self.tilemap.wrap_around(add_vecs(
+                    self.tilemap.portals[shot.pos][0], shot.heading)))
+
+        # Handling a collision changes the spatial hash, so take a
+        # snapshot of the contested positions first.
+        contested = [list(self.spatialhash[pos])
+                     for pos in self.spatialhash.contested]
+        tag_info = self.spatialhash.tag_info
+        handlers = self.collision_handlers
+
+        for entries in contested:
+            flags = [tag_info[tag][0] for tag, _ in entries]
+
+            for i in range(len(entries) - 1):
+                for j in range(i + 1, len(entries)):
+                    handler = handlers.get((flags[i], flags[j]))
+                    if handler is not None:
+                        handler(entries[i], entries[j])
+
+                    handler = handlers.get((flags[j], flags[i]))
+                    if handler is not None:
+                        handler(entries[j], entries[i])
+
+    def get_owner(self, tag):
+        """Return the player owning a snake tag."""
+        return self.player_ids[self.spatialhash.tag_info[tag][1]]
+
+    def head_vs_snake(self, head, snake):
+        """Handle a snake's head running into a snake."""
+        self.get_owner(head[0]).hit_snake(snake[1])
+
+    def head_vs_portal(self, head, portal):
+        """Handle a snake's head entering a portal."""
+        self.get_owner(head[0]).enter_portal(portal[1])
+
+    def head_vs_pwrup(self, head, pwrup):
+        """Handle a snake's head collecting a powerup."""
+        if pwrup[1].isalive:
+            self.get_owner(head[0]).collect_pwrup(pwrup[1])
+
+    def snake_vs_shot(self, part, shot):
+        """Handle a shot hitting a snake."""
+        if shot[1].isalive:
+            self.get_owner(part[0]).handle_shot(shot[1])
+
+    def insert_static(self):
+        """Insert the static objects of the map into the spatial hash."""
+        # Add spawnpoints (So powerups don't appear on them)
+        for spawnpoint in self.tilemap.spawnpoints:
+            self.spatialhash.insert(spawnpoint, SPAWNPOINT_TAG, spawnpoint)
+
+        # Add portals
+        for portal_key, portal_val in list(self.tilemap.portals.items()):
+            self.spatialhash.insert(portal_key, PORTAL_TAG, portal_val)
+
+
+def run_bot_match(map_path, num_bots, seed, pwrup, time_limit,
+                  bot_config=None):
+    """
+    Run a single match between bots without rendering anything.
+    :param bot_config: extra config entries passed to every bot
+    :return: the simulation after the match has ended
+    """
+    sim = Simulation(map_path, random.Random(seed))
+    sim.reset()
+
+    for pid in range(num_bots):
+        config = {'id': pid, 'color': None, 'skin': None}
+        config.update(bot_config or {})
+        sim.add_player(Bot(sim, sim.player_dead, config))
+
+    sim.start()
+    sim.pwrup_manager.spawn_pwrup(pwrup, 1)
+
+    max_ticks = secs_to_ticks(time_limit)
+
+    while not sim.is_over and sim.ticks < max_ticks:
+        sim.tick()
+
+    return sim
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run headless bot matches')
+    parser.add_argument('--map', default=DEFAULT_MAP)
+    parser.add_argument('--bots', type=int, default=2)
+    parser.add_argument('--matches', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--powerup', default=DEFAULT_PWRUP)
+    parser.add_argument('--time-limit', type=float, default=60.)
+    parser.add_argument('--incremental', action='store_true',
+                        help='bots replan around snakes with D* Lite')
+    parser.add_argument('--dynamic-obstacles', action='store_true',
+                        help='bots replan around snakes with A*, looking '
+                        'ahead at when their bodies move away')
+
+    args = parser.parse_args()
+    bot_config = None
+
+    if args.incremental or args.dynamic_obstacles:
+        bot_config = {'flow_fields': False, 'incremental': args.incremental,
+                      'dynamic_obstacles': args.dynamic_obstacles}
+
+    for match in range(args.matches):
+        sim = run_bot_match(args.map, args.bots, args.seed + match,
+                            args.powerup, args.time_limit, bot_config)
+        points = ' '.join('{0}'.format(player.points)
+                          for player in sim.players)
+        print('match {0}: {1:.2f}s points: {2}'.format(
+            match, sim.elapsed_t, points))
+
+
+if __name__ == '__main__':
+    main()
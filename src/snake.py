@@ -3,13 +3,13 @@
 Snake module.
 """
 
-from pygame import Rect
-
 from constants import (MAX_HITPOINTS,
-                       INIT_SPEED, MIN_SPEED, MAX_SPEED)
+                       INIT_SPEED, MIN_SPEED, MAX_SPEED, STEP_UNITS)
 from constants import INVINCIBILITY_BLINK_RATE
-from utils import add_vecs, sub_vecs, normalize, m_distance
-from core.map import wrap_around, on_edge
+from utils import (add_vecs, sub_vecs, normalize, m_distance,
+                   secs_to_ticks, rate_to_units)
+from core.occupancy import HEAD_CELL, BODY_CELL
+from camera import get_offset
 
 # -- Directions --
 EAST = (+1, 0)
@@ -18,10 +18,10 @@ NORTH = (0, -1)
 SOUTH = (0, +1)
 DIRECTIONS = {'E': EAST, 'W': WEST, 'N': NORTH, 'S': SOUTH}
 
-STRAIGHT1_V = Rect(20, 20, 10, 10)
-STRAIGHT1_H = Rect(20, 30, 10, 10)
-STRAIGHT2_V = Rect(30, 20, 10, 10)
-STRAIGHT2_H = Rect(30, 30, 10, 10)
+STRAIGHT1_V = (20, 20, 10, 10)
+STRAIGHT1_H = (20, 30, 10, 10)
+STRAIGHT2_V = (30, 20, 10, 10)
+STRAIGHT2_H = (30, 30, 10, 10)
 
 N = 0x1
 E = 0x2
@@ -38,14 +38,14 @@ VERTICAL = 0x20
 # Maps vectors to their corresponding direction flags.
 VEC_TO_DIRFLAG = {(0, -1): N, (1, 0): E, (0, 1): S, (-1, 0): W}
 
-HEAD = {N: Rect(00, 00, 10, 10), S: Rect(10, 10, 10, 10),
-        E: Rect(10, 00, 10, 10), W: Rect(00, 10, 10, 10)}
+HEAD = {N: (00, 00, 10, 10), S: (10, 10, 10, 10),
+        E: (10, 00, 10, 10), W: (00, 10, 10, 10)}
 
-TAIL = {N: Rect(20, 00, 10, 10), S: Rect(30, 10, 10, 10),
-        E: Rect(30, 00, 10, 10), W: Rect(20, 10, 10, 10)}
+TAIL = {N: (20, 00, 10, 10), S: (30, 10, 10, 10),
+        E: (30, 00, 10, 10), W: (20, 10, 10, 10)}
 
-TURN = {SE: Rect(00, 20, 10, 10), SW: Rect(10, 20, 10, 10),
-        NE: Rect(00, 30, 10, 10), NW: Rect(10, 30, 10, 10)}
+TURN = {SE: (00, 20, 10, 10), SW: (10, 20, 10, 10),
+        NE: (00, 30, 10, 10), NW: (10, 30, 10, 10)}
 
 
 def get_next_to_portal(pos, tilemap):
@@ -76,7 +76,7 @@ def get_arrangement(snake, index, tilemap):
     ba_apart = m_distance(vec_a, vec_b) > 1
     bc_apart = m_distance(vec_c, vec_b) > 1
 
-    a_on_edge = on_edge(vec_a)
+    a_on_edge = tilemap.on_edge(vec_a)
 
     if ba_apart:
         if a_on_edge:
@@ -107,6 +107,95 @@ def get_arrangement(snake, index, tilemap):
         return VEC_TO_DIRFLAG[vec_ba] | VEC_TO_DIRFLAG[vec_bc]
 
 
+def get_sprite(snake, index, tilemap):
+    """
+    Get the skin areas of a body part for odd and even indices. Only
+    straight parts alternate between two areas.
+    """
+    argm = get_arrangement(snake, index, tilemap)
+
+    if argm & STRAIGHT == STRAIGHT:
+        if argm & VERTICAL == VERTICAL:
+            return STRAIGHT2_V, STRAIGHT1_V
+        return STRAIGHT2_H, STRAIGHT1_H
+
+    area = TURN[argm & 15]
+    return area, area
+
+
+class SnakeBody(object):
+
+    """
+    Ring buffer holding the positions of a snake's parts, head first.
+    Adding or removing parts at either end and indexing are O(1).
+    """
+
+    def __init__(self, parts=(), capacity=16):
+        parts = list(parts)
+        self._buf = parts + [None] * max(capacity - len(parts), 1)
+        self._start = 0
+        self._len = len(parts)
+
+    def _grow(self):
+        """Double the capacity of the buffer."""
+        self._buf = list(self) + [None] * len(self._buf)
+        self._start = 0
+
+    def _index(self, i):
+        """Translate an index into an index of the buffer."""
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('snake body index out of range')
+        return (self._start + i) % len(self._buf)
+
+    def push_front(self, pos):
+        """Add a part in front of the head."""
+        if self._len == len(self._buf):
+            self._grow()
+        self._start = (self._start - 1) % len(self._buf)
+        self._buf[self._start] = pos
+        self._len += 1
+
+    def pop_front(self):
+        """Remove and return the head."""
+        pos = self[0]
+        self._buf[self._start] = None
+        self._start = (self._start + 1) % len(self._buf)
+        self._len -= 1
+        return pos
+
+    def push_back(self, pos):
+        """Add a part behind the tail."""
+        if self._len == len(self._buf):
+            self._grow()
+        self._buf[(self._start + self._len) % len(self._buf)] = pos
+        self._len += 1
+
+    def pop_back(self):
+        """Remove and return the tail."""
+        index = self._index(-1)
+        pos = self._buf[index]
+        self._buf[index] = None
+        self._len -= 1
+        return pos
+
+    def __getitem__(self, i):
+        return self._buf[self._index(i)]
+
+    def __setitem__(self, i, pos):
+        self._buf[self._index(i)] = pos
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        buf = self._buf
+        size = len(buf)
+        for i in range(self._start, self._start + self._len):
+            yield buf[i % size]
+
+
 class SnakeNormalState(object):
 
     """
@@ -116,7 +205,7 @@ class SnakeNormalState(object):
     def __init__(self, snake):
         self.snake = snake
 
-    def update(self, delta_time):
+    def update(self):
         """Update state."""
         self.snake.move()
 
@@ -130,17 +219,18 @@ class SnakeInvincibleState(object):
     def __init__(self, snake, lifetime):
         self.snake = snake
         self.snake.isinvincible = True
-        self.lifetime = lifetime
-        self.elapsed_lifetime = 0.
-        self.elapsed_blink = 0.
+        self.lifetime = secs_to_ticks(lifetime)
+        self.blinkrate = secs_to_ticks(INVINCIBILITY_BLINK_RATE)
+        self.elapsed_lifetime = 0
+        self.elapsed_blink = 0
 
-    def update(self, delta_time):
+    def update(self):
         """Update state."""
-        self.elapsed_lifetime += delta_time
-        self.elapsed_blink += delta_time
+        self.elapsed_lifetime += 1
+        self.elapsed_blink += 1
 
-        if self.elapsed_blink >= INVINCIBILITY_BLINK_RATE:
-            self.elapsed_blink -= INVINCIBILITY_BLINK_RATE
+        if self.elapsed_blink >= self.blinkrate:
+            self.elapsed_blink -= self.blinkrate
             self.snake.isvisible = not self.snake.isvisible
 
         if self.elapsed_lifetime >= self.lifetime:
@@ -160,17 +250,28 @@ class Snake(object):
     Represents a snake.
     """
 
-    def __init__(self, game, pos, skin, _id, killed_handler, config):
-        self.game = game
+    def __init__(self, sim, pos, skin, _id, killed_handler, config):
+        self.sim = sim
         self.body_tag = '#p{0}-body'.format(_id)
         self.head_tag = '#p{0}-head'.format(_id)
         self.skin = skin
-        self.body = [pos, (pos[0] + 1, pos[1])]
+        self.spatialhash = sim.spatialhash
+        self.spatialhash.register_tag(self.head_tag, HEAD_CELL, _id)
+        self.spatialhash.register_tag(self.body_tag, BODY_CELL, _id)
+        self.body = SnakeBody()
+        # Skin areas of the body parts, computed once a part has both
+        # of its neighbors. The part right behind the head is computed
+        # when drawing since the head can still be moved by a portal.
+        self.sprites = SnakeBody()
+        # Undo log of the changes made to the body since the last step,
+        # used to set the snake back to its previous position.
+        self.undo_log = []
+        self.set_body(self.get_spawn_body(pos))
         self.heading = None
         self._hitpoints = config.get('hp', MAX_HITPOINTS)
         self._speed = config.get('speed', INIT_SPEED)
         self._speed_bonus = 0
-        self.elapsed_t = 0.
+        self.move_progress = 0
         self.grow = 0
         self.isalive = True
         self.isvisible = True
@@ -178,7 +279,6 @@ class Snake(object):
         self.ismoving = False
         self.curr_state = SnakeInvincibleState(self, 5)
         self.killed_event = killed_handler
-        self.prev = self.body[:]
         self.prev_heading = self.heading
 
     @property
@@ -246,20 +346,22 @@ class Snake(object):
     def take_damage(self, dmg, dealt_by, setback=False,
                     invincible=False, invinc_lifetime=0, shrink=0, slowdown=0):
         """Take damage."""
+        if setback:
+            # Set the snake back to its previous position
+            self.undo()
+
         if not self.isinvincible:
             self.hitpoints -= dmg
             for _ in range(shrink):
                 if len(self.body) == 2:
                     break
                 if setback:
-                    self.prev.pop()
+                    self._pop_tail()
                 else:
-                    self.body.pop()
+                    self.pop_tail()
             self.gain_speed(-slowdown)
 
         if setback:
-            # Set the snake back to its previous position
-            self.body = self.prev[:]
             xpos = 0
             ypos = 0
             if self.body[0][0] > self.body[1][0]:
@@ -280,9 +382,16 @@ class Snake(object):
             self.isalive = False
             self.killed_event(dealt_by)
 
+    def get_spawn_body(self, pos):
+        """
+        Return the body of a snake spawning at pos, its head at pos and
+        its tail east of it, across the edge of the map if need be.
+        """
+        return [pos, self.sim.tilemap.wrap_around((pos[0] + 1, pos[1]))]
+
     def respawn(self, pos):
         """Respawn snake."""
-        self.body = [pos, (pos[0] + 1, pos[1])]
+        self.set_body(self.get_spawn_body(pos))
         self._speed = INIT_SPEED
         self.heading = None
         self.prev_heading = None
@@ -290,94 +399,165 @@ class Snake(object):
         self.isalive = True
         self.hitpoints = MAX_HITPOINTS
         self.change_state(SnakeInvincibleState(self, 3.5))
-        self.elapsed_t = 0
+        self.move_progress = 0
 
-    def update(self, delta_time):
-        """Update snake."""
+    def update(self):
+        """Advance snake by one tick."""
         if not self.isalive:
             return
 
         if self.ismoving:
-            self.elapsed_t += delta_time
+            self.move_progress += rate_to_units(self._speed +
+                                                self._speed_bonus)
 
-        self.curr_state.update(delta_time)
+        self.curr_state.update()
 
     def move(self):
         """Move snake."""
         if not self.ismoving:
             return
 
-        self.body[0] = wrap_around(self.body[0])
         # Move Snake
-        if self.elapsed_t >= 1. / (self._speed + self._speed_bonus):
-            self.prev = self.body[:]
-            self.elapsed_t -= 1. / (self._speed + self._speed_bonus)
-            self.body.insert(0, add_vecs(self.body[0], self.heading))
+        if self.move_progress >= STEP_UNITS:
+            del self.undo_log[:]
+            self.move_progress -= STEP_UNITS
+            self.push_head(self.sim.tilemap.wrap_around(
+                add_vecs(self.body[0], self.heading)))
             if self.grow == 0:
-                self.body.pop()
+                self.pop_tail()
             elif self.grow > 0:
                 self.grow -= 1
             elif self.grow < 0:
                 for _ in range(-self.grow+1):
                     if len(self.body) == 2:
                         break
-                    self.body.pop()
+                    self.pop_tail()
                 self.grow = 0
 
-    def draw(self):
-        """Draw snake."""
+    def push_head(self, pos):
+        """Add a new head, the old head becomes part of the body."""
+        self._push_head(pos)
+        self.undo_log.append((self._pop_head,))
+
+    def pop_tail(self):
+        """Remove the last part of the body."""
+        self.undo_log.append((self._push_tail, self._pop_tail()))
+
+    def undo(self):
+        """Revert the changes made to the body since the last step."""
+        while self.undo_log:
+            entry = self.undo_log.pop()
+            entry[0](*entry[1:])
+
+    def _push_head(self, pos):
+        self.spatialhash.retag(self.body[0], self.head_tag, self.body_tag,
+                               self)
+        self.spatialhash.insert(pos, self.head_tag, self)
+        self.body.push_front(pos)
+        self.sprites.push_front(None)
+
+        if len(self.body) > 3:
+            self.sprites[2] = get_sprite(self.body, 2, self.sim.tilemap)
+
+    def _pop_head(self):
+        self.spatialhash.remove(self.body.pop_front(), self.head_tag, self)
+        self.sprites.pop_front()
+        self.spatialhash.retag(self.body[0], self.body_tag, self.head_tag,
+                               self)
+
+    def _push_tail(self, pos):
+        self.spatialhash.insert(pos, self.body_tag, self)
+        self.body.push_back(pos)
+        self.sprites.push_back(None)
+
+    def _pop_tail(self):
+        pos = self.body.pop_back()
+        self.sprites.pop_back()
+        self.spatialhash.remove(pos, self.body_tag, self)
+        return pos
+
+    def _set_part(self, i, pos):
+        tag = self.head_tag if i == 0 else self.body_tag
+        self.spatialhash.move(self.body[i], pos, tag, self)
+        self.body[i] = pos
+
+        for index in range(max(i - 1, 0), min(i + 2, len(self.body))):
+            self.sprites[index] = None
+
+    def set_body(self, body):
+        """Replace the whole body."""
+        for index, part in enumerate(self.body):
+            self.spatialhash.remove(part, self.body_tag if index else
+                                    self.head_tag, self)
+
+        self.body = SnakeBody(body)
+        self.sprites = SnakeBody([None] * len(body))
+        del self.undo_log[:]
+
+        for index, part in enumerate(self.body):
+            self.spatialhash.insert(part, self.body_tag if index else
+                                    self.head_tag, self)
+
+    def draw(self, gfx, camera=None):
+        """Draw snake, only the parts in view if a camera is given."""
         if not self.isalive or not self.isvisible:
             return
 
-        body_len = len(self.body)
-        area = None
-        tilemap = self.game.current_state.mode.tilemap
+        body = self.body
+        sprites = self.sprites
+        last = len(body) - 1
+        tilemap = self.sim.tilemap
+        in_view = camera.contains if camera is not None else None
+        cells = []
 
-        for index, part in enumerate(self.body):
-            if index == 0:
-                if self.heading and self.heading != (0, 0):
-                    area = HEAD[VEC_TO_DIRFLAG[self.heading]]
-                else:
-                    area = HEAD[W]
-
-            elif 0 < index < (body_len - 1):
-                argm = get_arrangement(self.body, index, tilemap)
-
-                if argm & STRAIGHT == STRAIGHT:
-                    if argm & VERTICAL == VERTICAL:
-                        if index % 2:
-                            area = STRAIGHT1_V
-                        else:
-                            area = STRAIGHT2_V
-                    else:
-                        if index % 2:
-                            area = STRAIGHT1_H
-                        else:
-                            area = STRAIGHT2_H
-                else:
-                    area = TURN[argm & 15]
+        if in_view is None or in_view(body[0]):
+            if self.heading and self.heading != (0, 0):
+                cells.append((body[0], HEAD[VEC_TO_DIRFLAG[self.heading]]))
             else:
-                if self.heading and self.heading != (0, 0):
-                    tail = self.body[body_len-1]
-                    second_last = self.body[body_len-2]
-                    apart = m_distance(tail, second_last) > 1
+                cells.append((body[0], HEAD[W]))
 
-                    if apart:
-                        portal = get_next_to_portal(tail, tilemap)
+        for index in range(1, last):
+            if in_view is not None and not in_view(body[index]):
+                continue
 
-                        if portal:
-                            second_last = portal
+            sprite = sprites[index]
 
-                    vec = sub_vecs(second_last, tail)
+            if sprite is None:
+                sprite = get_sprite(body, index, tilemap)
 
-                    area = TAIL[VEC_TO_DIRFLAG[normalize(vec)]]
-                else:
-                    area = TAIL[W]
+                if index > 1:
+                    sprites[index] = sprite
+
+            cells.append((body[index], sprite[index % 2]))
+
+        if in_view is None or in_view(body[last]):
+            cells.append((body[last], self.get_tail_sprite()))
+
+        gfx.draw_cells(self.skin, cells, get_offset(camera))
+
+    def get_tail_sprite(self):
+        """Return the sprite of the tail, pointing along the body."""
+        if not self.heading or self.heading == (0, 0):
+            return TAIL[W]
+
+        body = self.body
+        tail = body[-1]
+        second_last = body[len(body) - 2]
+        apart = m_distance(tail, second_last) > 1
+
+        if apart:
+            portal = get_next_to_portal(tail, self.sim.tilemap)
+
+            if portal:
+                second_last = portal
+
+        vec = sub_vecs(second_last, tail)
 
-            self.game.graphics.draw(self.skin, part, area=area)
+        return TAIL[VEC_TO_DIRFLAG[normalize(vec)]]
 
     def __setitem__(self, i, item):
-        self.body[i] = item
+        self.undo_log.append((self._set_part, i, self.body[i]))
+        self._set_part(i, item)
 
     def __getitem__(self, i):
         return self.body[i]
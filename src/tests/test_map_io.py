@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Round trips of tile maps through write_to_file and read_zip_map, and
+through the binary format.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from core.map import TileMapBase, read_zip_map
+from core.binmap import write_binary_map, read_binary_map
+from utils import atomic_write
+
+COLS = 40
+ROWS = 20
+
+
+class MapIOTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.battle-snakes.map')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_map(self):
+        tilemap = TileMapBase('', COLS, ROWS)
+        tilemap.title = 'round trip'
+        tilemap.description = 'a map with everything'
+        tilemap.textures = {1: 'tile_water_1', 2: 'tile_wall_1'}
+        tilemap.spawnpoints = [(3, 4), (30, 15)]
+        tilemap.add_portal((5, 5), (35, 10), (1, 0), (-1, 0))
+
+        for pos_x in range(COLS):
+            tilemap.tiles[pos_x, 0] = 2
+            tilemap.blocked.add((pos_x, 0))
+
+        tilemap.tiles[7, 12] = 1
+        tilemap.tiles[39, 19] = 300
+        return tilemap
+
+    def assert_same_map(self, tilemap, data):
+        self.assertEqual((data['cols'], data['rows']),
+                         (tilemap.width, tilemap.height))
+        self.assertEqual(data['title'], tilemap.title)
+        self.assertEqual(data['description'], tilemap.description)
+        self.assertEqual(data['textures'], tilemap.textures)
+        self.assertEqual(data['spawnpoints'], tilemap.spawnpoints)
+        self.assertEqual(data['portals'], tilemap.portals)
+        self.assertEqual(data['blocked'], tilemap.blocked)
+        self.assertEqual(data['tiles'], tilemap.tiles)
+
+    def test_round_trip(self):
+        tilemap = self.make_map()
+        tilemap.write_to_file(self.path)
+
+        self.assert_same_map(tilemap, read_zip_map(self.path))
+
+    def test_round_trip_empty_map(self):
+        tilemap = TileMapBase('', COLS, ROWS)
+        tilemap.write_to_file(self.path)
+        data = read_zip_map(self.path)
+
+        self.assert_same_map(tilemap, data)
+        self.assertEqual(data['tiles'].chunks, {})
+
+    def test_load_written_map(self):
+        tilemap = self.make_map()
+        tilemap.write_to_file(self.path)
+        loaded = TileMapBase(self.path)
+
+        self.assertEqual(loaded.tiles, tilemap.tiles)
+        self.assertEqual(loaded.blocked, tilemap.blocked)
+        self.assertEqual(loaded.portals, tilemap.portals)
+        self.assertEqual(loaded.spawnpoints, tilemap.spawnpoints)
+
+    def test_binary_round_trip(self):
+        tilemap = self.make_map()
+        tilemap._load_islands()
+        path = os.path.join(self.directory, 'test.battle-snakes.bmap')
+        write_binary_map(tilemap, path)
+        data = read_binary_map(path)
+
+        self.assert_same_map(tilemap, data)
+        self.assertEqual(data['num_islands'], tilemap.num_islands)
+        self.assertEqual(data['island_labels'], tilemap.island_labels)
+        # Few islands fit into one byte per cell
+        self.assertEqual(data['island_labels'].itemsize, 1)
+
+    def test_failed_write_keeps_file(self):
+        self.make_map().write_to_file(self.path)
+
+        with open(self.path, 'rb') as map_file:
+            before = map_file.read()
+
+        # Textures which can't be stored as JSON make the write fail
+        broken = self.make_map()
+        broken.textures = {1: object()}
+
+        with self.assertRaises(TypeError):
+            broken.write_to_file(self.path)
+
+        with open(self.path, 'rb') as map_file:
+            self.assertEqual(map_file.read(), before)
+
+        self.assertEqual(os.listdir(self.directory),
+                         ['test.battle-snakes.map'])
+
+    def test_failed_write_of_new_file(self):
+        with self.assertRaises(RuntimeError):
+            with atomic_write(self.path) as new_file:
+                new_file.write(b'partial')
+                raise RuntimeError()
+
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
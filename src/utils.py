@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 """Contains useful functions/classes"""
 
+import os
+import stat
+import tempfile
 from math import hypot
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from constants import TICK_RATE, RATE_SCALE
 
 
 def grid(cols, rows):
@@ -11,6 +18,27 @@ def grid(cols, rows):
             yield (col, row)
 
 
+def to_bitboard(indices, size):
+    """Return an int with the bits of the given flat indices set."""
+    bits = bytearray((size + 7) // 8)
+
+    for index in indices:
+        bits[index >> 3] |= 1 << (index & 7)
+
+    return int.from_bytes(bits, 'little')
+
+
+def iter_bits(board):
+    """Yield the flat indices of the bits set in board."""
+    data = board.to_bytes((board.bit_length() + 7) // 8, 'little')
+
+    for byte_index, byte in enumerate(data):
+        while byte:
+            low_bit = byte & -byte
+            yield byte_index * 8 + low_bit.bit_length() - 1
+            byte ^= low_bit
+
+
 def get_adjacent(pos, cols, rows):
     """Get adjacent tiles in a grid."""
     if pos[0] > 0:
@@ -56,6 +84,20 @@ def normalize(vec):
     return int(round(vec[0] / length)), int(round(vec[1] / length))
 
 
+def secs_to_ticks(secs):
+    """Convert a duration in seconds to simulation ticks."""
+    return int(round(secs * TICK_RATE))
+
+
+def rate_to_units(rate):
+    """
+    Convert a rate given per second to progress units per tick.
+    Progress accumulated over ticks reaches STEP_UNITS exactly once
+    per 1 / rate seconds.
+    """
+    return int(round(rate * RATE_SCALE))
+
+
 def str_to_vec(data):
     """Convert string rep. of a vector to tuple."""
     return tuple(int(i) for i in data.strip().split(b':'))
@@ -78,17 +120,101 @@ def str_to_vec_lst(data):
 
 def vec_lst_to_str(lst):
     """Convert list of tuples to string rep."""
-    str_rep = ''
-    for i, vec in enumerate(lst):
-        sep = ';' if i != 0 else ''
-        str_rep += '{0}{1}:{2}'.format(sep, vec[0], vec[1])
-    return str_rep
+    return ';'.join('{0}:{1}'.format(vec[0], vec[1]) for vec in lst)
+
+
+@contextmanager
+def atomic_write(file_path):
+    """
+    Open a temporary binary file next to file_path for writing. It
+    replaces file_path once the block is done, or is removed if the block
+    fails, so file_path is never left half written.
+    """
+    directory, name = os.path.split(os.path.abspath(file_path))
+    handle, temp_path = tempfile.mkstemp(prefix='.' + name + '.',
+                                         suffix='.tmp', dir=directory)
+
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            yield temp_file
+
+        # mkstemp creates files only the owner can read
+        try:
+            mode = stat.S_IMODE(os.stat(file_path).st_mode)
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+class LRUCache(object):
+
+    """
+    Mapping holding at most maxsize entries. When full, the least
+    recently used entry is evicted. Hits and misses are counted.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """Return the value of key and mark it as recently used."""
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Insert or replace the value of key.
+        :return: the evicted (key, value) pair or None
+        """
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        if len(self._entries) > self.maxsize:
+            return self._entries.popitem(last=False)
+
+        return None
+
+    def discard(self, key):
+        """Remove key if present."""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
 
 
 class Timer(object):
 
     """
-    Simple infinite timer.
+    Simple infinite timer. Interval and delay are given in ticks.
 
     Note: Timer cannot be stopped.
     """
@@ -96,7 +222,7 @@ class Timer(object):
     def __init__(self, intervall, tick, delay=0, running=False):
         self.intervall = intervall
         self.tick = tick
-        self.elapsed_t = 0.
+        self.elapsed_ticks = 0
         self.delay = delay
         self.running = running if self.delay == 0 else False
 
@@ -106,21 +232,21 @@ class Timer(object):
             self.delay = delay
             return
         self.running = True
-        self.elapsed_t = 0.
+        self.elapsed_ticks = 0
 
-    def update(self, delta_time):
-        """Update timer."""
+    def update(self):
+        """Advance timer by one tick."""
         if self.running:
-            self.elapsed_t += delta_time
-            if self.elapsed_t >= self.intervall:
-                self.elapsed_t -= self.intervall
+            self.elapsed_ticks += 1
+            if self.elapsed_ticks >= self.intervall:
+                self.elapsed_ticks -= self.intervall
                 # On tick
                 if self.tick is not None:
                     self.tick()
                 else:
                     raise Exception('No Tick-event handler!')
-        elif self.delay > 0.:
-            self.elapsed_t += delta_time
-            if self.elapsed_t >= self.delay:
+        elif self.delay > 0:
+            self.elapsed_ticks += 1
+            if self.elapsed_ticks >= self.delay:
                 self.running = True
-                self.elapsed_t = 0.
+                self.elapsed_ticks = 0